@@ -31,6 +31,7 @@ import platform
 import datetime
 from base64 import b64decode
 import traceback
+from collections import deque
 
 import threading
 import cairo
@@ -42,71 +43,215 @@ import ConfigParser
 from os.path import expanduser
 
 from Platform    import pi_version
-from temperature import measure_temperatures
+from temperature import measure_temperatures, start_sampling
 from logger      import ldebug, linfo, lerror, set_loglevel, LOG_DEBUG, LOG_INFO
+from scene       import *
+from pagecache   import PageCache, page_key
+from textmeasure import TextMeasure
+from scheduler   import Scheduler
+from resourcecache import ResourceCache
 
 import robinson
 
-LED_UPDATE   =  50
-TEMP_UPDATE  = 100
+# ms between animation frames
+FRAME_TIME     = 20
 
-def hal_comm (socket, cmd, arg):
+# typewriter effect: scene commands revealed per second, text costs one per char
+TYPE_SPEED     = 1600
+
+# seconds between temperature reports / page cache expiry runs / debug stats
+TEMP_INTERVAL  = 30
+CACHE_INTERVAL = 60
+STATS_INTERVAL = 600
+
+# laid out pages not shown for this many seconds are dropped from the cache
+PAGE_CACHE_AGE = 600
+
+# ms to wait for getty's reply, per command; .halrc [timeouts] <command> = <ms>
+HAL_TIMEOUT  = 2000
+HAL_TIMEOUTS = { 'TERM_BOOT'     : 5000,
+                 'LOAD_RESOURCE' : 5000,
+                 'TEMPERATURE'   : 1000 }
+
+# resends after a timeout, ms to wait before the first one (doubled for each further one)
+HAL_RETRIES  = 2
+HAL_BACKOFF  = 50
+
+class hal_socket (object):
+
+    """REQ socket to getty that is thrown away and recreated when a reply
+       is lost (a REQ socket can't send again until it got one)"""
+
+    def __init__(self, context, addr):
+
+        self.context  = context
+        self.addr     = addr
+        self.socket   = None
+
+        self.requests = 0
+        self.timeouts = 0
+        self.retries  = 0
+        self.failures = 0
+
+        self.connect()
+
+    def connect(self):
+
+        if self.socket is not None:
+            self.socket.close()
+
+        self.socket = self.context.socket(zmq.REQ)
+        # don't keep unanswered requests around after close()
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect (self.addr)
+
+    def stats(self):
+        return "%d requests, %d timeouts, %d retries, %d failed" % (self.requests, self.timeouts, self.retries, self.failures)
+
+#
+# monotonic clock for animations (python 2 has no time.monotonic),
+# unaffected by NTP or manual changes of the wall clock
+#
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+try:
+    _clock_gettime = ctypes.CDLL('librt.so.1', use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(timespec) ]
+
+    def monotonic():
+        ts = timespec()
+        if _clock_gettime (CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError (ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+except (OSError, AttributeError):
+    monotonic = time.time
+
+def hal_comm_parts (sock, cmd, arg):
+
+    """request/reply on hal_socket sock. If no reply arrives in time, the
+       socket is recreated and the request sent again, up to HAL_RETRIES
+       times. Returns (reply, [further frames]), the frames as received
+       (zmq.Frame, not copied); reply is None if getty could not be reached."""
 
     reply = None
+    parts = []
+
+    timeout = HAL_TIMEOUTS.get(cmd, HAL_TIMEOUT)
+    backoff = HAL_BACKOFF
+    sock.requests += 1
 
     try:
 
         rq = json.dumps ([cmd, arg])
 
-        ldebug ("hal_comm: sending %s" % rq)
-        socket.send (rq)
+        for attempt in range(HAL_RETRIES + 1):
+
+            if attempt > 0:
+                sock.retries += 1
+                time.sleep (backoff / 1000.0)
+                backoff *= 2
 
-        #  Get the reply.
-        message = socket.recv()
+            ldebug ("hal_comm: sending %s" % rq)
+            sock.socket.send (rq)
+
+            #  Get the reply.
+            if sock.socket.poll(timeout, zmq.POLLIN):
+                frames = sock.socket.recv_multipart(copy=False)
+                reply  = json.loads(frames[0].bytes)
+                parts  = frames[1:]
+                break
+
+            sock.timeouts += 1
+            lerror ("hal_comm: no reply to %s within %d ms (%s)" % (cmd, timeout, sock.stats()))
+            sock.connect()
+
+        else:
+            sock.failures += 1
 
-        reply = json.loads(message)
     except:
         traceback.print_exc()
 
-    return reply
+    return reply, parts
+
+def hal_comm (sock, cmd, arg):
+    """request/reply on hal_socket sock, see hal_comm_parts()"""
+    return hal_comm_parts (sock, cmd, arg)[0]
+
+def drain_broadcasts (sock):
+
+    """read all pending broadcasts. Of a burst of DISPLAY_HTML messages only
+       the newest one is visible anyway, so the others are dropped (without
+       even parsing them). Returns ([(cmd, json data), ...], dropped pages)"""
+
+    msgs    = []
+    html    = None
+    dropped = 0
+
+    while True:
+
+        try:
+            msg = sock.recv(zmq.NOBLOCK)
+        except zmq.Again:
+            break
+
+        cmd, data = msg.split(' ', 1)
+
+        if cmd == 'DISPLAY_HTML':
+            if html is not None:
+                dropped += 1
+            html = data
+            continue
+
+        msgs.append ( (cmd, data) )
+
+    if html is not None:
+        msgs.append ( ('DISPLAY_HTML', html) )
 
+    return msgs, dropped
 
-def _load_resource (resourcefn):
-    global socket
-    return b64decode(hal_comm (socket, 'LOAD_RESOURCE', resourcefn))
 
+# damage rectangles per frame before we merge them into their bounding box
+MAX_DAMAGE_RECTS = 8
 
-DRAW_SPEED = 32
+# ms telemetry reports are collected before they are sent
+TELEMETRY_BATCH   = 1000
+# unchanged values are sent again after this many seconds anyway
+TELEMETRY_REFRESH = 600
+# smallest change of a float value that is reported
+TELEMETRY_DELTA   = 0.1
+# reports queued by zmq before further ones are dropped
+TELEMETRY_HWM     = 16
 
-SCMD_SET_SOURCE_RGBA    =  1
-SCMD_PAINT              =  2
-SCMD_SELECT_FONT_FACE   =  3
-SCMD_SET_FONT_SIZE      =  4
-SCMD_MOVE_TO            =  5
-SCMD_SHOW_TEXT          =  6
-SCMD_REL_LINE_TO        =  7
-SCMD_CLOSE_PATH         =  8
-SCMD_FILL               =  9
-SCMD_SET_LINE_WIDTH     = 10
-SCMD_SAVE               = 11
-SCMD_RESTORE            = 12
-SCMD_SET_SOURCE         = 13
-SCMD_CLIP               = 14
-SCMD_SET_SOURCE_SURFACE = 15
+# default memory budget for resources, .halrc [term] resource_cache_kb
+RESOURCE_CACHE_SIZE = 8 * 1024 * 1024
+
+# seconds a resource is used from the cache without asking getty again
+RESOURCE_TTL     = 60
+
+# KEYPRESS requests sent before their replies arrive / keys queued behind them
+KEYS_IN_FLIGHT   = 4
+KEY_QUEUE_MAX    = 32
+
+# ms after which we give up on a KEYPRESS reply and free its slot
+KEY_TIMEOUT      = 2000
+
+# default memory budget for laid out pages, .halrc [term] page_cache_kb
+PAGE_CACHE_SIZE  = 4 * 1024 * 1024
 
 def text_extents(self, font_face, font_size, text):
-    self.ctx.select_font_face (font_face)
-    self.ctx.set_font_size (font_size)
-    return self.ctx.text_extents (text)
+    return self.measure.text_extents (font_face, font_size, text)
 
 def font_extents(self, font_face, font_size):
-    self.ctx.select_font_face (font_face)
-    self.ctx.set_font_size (font_size)
-    return self.ctx.font_extents ()
+    return self.measure.font_extents (font_face, font_size)
 
 class HAL(object):
 
-    def __init__(self, gfx):
+    def __init__(self, gfx, cache_size=PAGE_CACHE_SIZE):
 
         self.gfx       = gfx
         self.ctx       = gfx.get_cairo_ctx()
@@ -114,126 +259,113 @@ class HAL(object):
         self.height    = gfx.height
 
         self.scene     = []
-        self.coffset   = 0
+        self.program   = self._compile()
+        self.start     = None   # monotonic() the typewriter effect started, None: no effect
+        self.drawn     = 0      # TYPE_SPEED units executed so far
+        self.frames    = 0      # frames drawn since scene_set()
+        self.full      = True   # next present needs a full texture upload
+        self.idle      = False
+
+        # layout state, may be used from a different thread than drawing
+        self.matrix    = self.ctx.get_matrix()
+        self.cache     = PageCache(cache_size)
+        self.measure   = TextMeasure(self.ctx)
 
         print "HAL.__init__() done."
 
     #
-    # anim scene support stuff in a cairo context lookalike way
+    # anim scene support
     #
 
-    def scene_reset(self, counter):
-        self.scene   = []
-        self.coffset = counter
-
-    def set_source_rgba (self, r, g, b, a):
-        self.scene.append ( (SCMD_SET_SOURCE_RGBA, r, g, b, a) )
+    def scene_set(self, scene, animate):
+        """make scene (as returned by layout()) the current one, revealed
+           by the typewriter animation starting now if animate is set"""
+        self.scene     = scene
+        self.program   = self._compile()
+        self.start     = monotonic() if animate else None
+        self.drawn     = 0
+        self.frames    = 0
+        self.full      = True
+        self.idle      = False
 
-    def paint (self):
-        self.scene.append ( (SCMD_PAINT, ) )
+        # previous page must not leak its path or clip into the new one
+        self.ctx.new_path()
+        self.ctx.reset_clip()
 
-    def select_font_face (self, font_face):
-        self.ctx.select_font_face (font_face)
-        self.scene.append ( (SCMD_SELECT_FONT_FACE, font_face) )
+    def invalidate(self):
+        """force a full present of the current scene"""
+        self.full      = True
+        self.idle      = False
 
-    def set_font_size (self, font_size):
-        self.ctx.set_font_size (font_size)
-        self.scene.append ( (SCMD_SET_FONT_SIZE, font_size) )
+    def _compile(self):
+        return SceneProgram (self.scene, self.ctx, (self.gfx.texture_width, self.gfx.texture_height))
 
-    def set_line_width (self, w):
-        self.scene.append ( (SCMD_SET_LINE_WIDTH, w) )
+    def layout (self, html, css, load_resource):
+        """lay out a page into a new scene, does not touch the render context
+           so it may run on another thread than scene_draw()"""
 
-    def move_to (self, x, y):
-        self.scene.append ( (SCMD_MOVE_TO, x, y) )
+        key   = page_key (html, css, self.width)
+        scene = self.cache.get (key)
 
-    def show_text (self, txt):
-        self.scene.append ( (SCMD_SHOW_TEXT, txt) )
+        if scene is None:
 
-    def rel_line_to (self, x, y):
-        self.scene.append ( (SCMD_REL_LINE_TO, x, y) )
+            rec  = SceneRecorder (self.measure)
+            html = robinson.html(html, css, self.width, load_resource, text_extents, font_extents, rec)
+            html.render (rec) 
 
-    def close_path (self):
-        self.scene.append ( (SCMD_CLOSE_PATH,) )
+            scene = optimize_scene (rec.scene, self.matrix, (self.width, self.height))
+            ldebug ("layout: optimized %d -> %d commands" % (len(rec.scene), len(scene)))
+            ldebug ("layout: text measure %s" % self.measure.stats())
 
-    def fill (self):
-        self.scene.append ( (SCMD_FILL,) )
+            self.cache.put (key, scene)
 
-    def rectangle (self, x, y, w, h):
-        self.move_to (x, y)
-        self.rel_line_to (w, 0)
-        self.rel_line_to (0, h)
-        self.rel_line_to (-w, 0)
-        self.close_path()
+        ldebug ("layout: page cache %s" % self.cache.stats())
 
-    def set_source (self, img):
-        self.scene.append ( (SCMD_SET_SOURCE, img) )
+        return scene
 
-    def set_source_surface (self, img, x, y):
-        self.scene.append ( (SCMD_SET_SOURCE_SURFACE, img, x, y) )
-
-    def clip (self):
-        self.scene.append ( (SCMD_CLIP,) )
-
-    def font_extents(self):
-        return self.ctx.font_extents()
-
-    def scene_html (self, html, css):
-        html = robinson.html(html, css, self.width, _load_resource, text_extents, font_extents, self)
-        html.render (self) 
-
-    def scene_draw(self, counter):
+    def scene_draw(self, now):
       
         #
         # cairo
         #
 
         self.ctx.set_operator (cairo.OPERATOR_OVER)
-        drawlimit = (counter - self.coffset) * DRAW_SPEED
 
-        # render scene by executing commands
+        # the cairo surface keeps everything drawn by previous frames, so we
+        # only execute the commands revealed since then (each command costs
+        # one TYPE_SPEED unit, text one unit per char). Progress depends on
+        # the time elapsed only: after a slow frame the next one catches up,
+        # so the effect takes as long on a Pi 1 as on a desktop.
 
-        for t in self.scene:
+        if self.start is None:
+            budget = sys.maxint
+        else:
+            budget = int((now - self.start) * TYPE_SPEED) - self.drawn
 
-            drawlimit -= 1
-            if drawlimit <= 0:
-                break
+        damage     = None if self.full else []
+        self.full  = False
 
-            #print "SCMD: %s" % repr(t)
-
-            scmd = t[0]
-            if scmd == SCMD_SET_SOURCE_RGBA:
-                self.ctx.set_source_rgba (t[1], t[2], t[3], t[4])
-            elif scmd == SCMD_PAINT:
-                self.ctx.paint()
-            elif scmd == SCMD_SELECT_FONT_FACE:
-                self.ctx.select_font_face (t[1])
-            elif scmd == SCMD_SET_FONT_SIZE:
-                self.ctx.set_font_size (t[1])
-            elif scmd == SCMD_MOVE_TO:
-                self.ctx.move_to (t[1], t[2])
-            elif scmd == SCMD_SHOW_TEXT:
-                self.ctx.show_text (t[1][:drawlimit])
-                drawlimit -= len(t[1])
-            elif scmd == SCMD_REL_LINE_TO:
-                self.ctx.rel_line_to (t[1], t[2])
-            elif scmd == SCMD_CLOSE_PATH:
-                self.ctx.close_path()
-            elif scmd == SCMD_FILL:
-                self.ctx.fill()
-            elif scmd == SCMD_SET_LINE_WIDTH:
-                self.ctx.set_line_width (t[1])
-            elif scmd == SCMD_SAVE:
-                self.ctx.save()
-            elif scmd == SCMD_RESTORE:
-                self.ctx.restore()
-            elif scmd == SCMD_SET_SOURCE:
-                self.ctx.set_source(t[1])
-            elif scmd == SCMD_CLIP:
-                self.ctx.clip()
-            elif scmd == SCMD_SET_SOURCE_SURFACE:
-                self.ctx.set_source_surface(t[1], t[2], t[3])
-
-        self.gfx.swap_buffers()        
+        self.drawn += budget - self.program.run (budget, damage)
+        self.frames += 1
+
+        # once the whole scene is visible nothing changes until the next
+        # scene_set() or invalidate()
+        self.idle = self.program.done()
+
+        if self.idle and self.start is not None:
+            t = now - self.start
+            ldebug ("scene_draw: typewriter took %.2f s, %d frames, %d dropped" % \
+                    (t, self.frames, max(0, int(t * 1000.0 / FRAME_TIME) - self.frames)))
+            self.start = None
+
+        if damage is not None and len(damage) > MAX_DAMAGE_RECTS:
+            x1 = min([d[0]        for d in damage])
+            y1 = min([d[1]        for d in damage])
+            x2 = max([d[0] + d[2] for d in damage])
+            y2 = max([d[1] + d[3] for d in damage])
+            damage = [ (x1, y1, x2 - x1, y2 - y1) ]
+
+        self.gfx.swap_buffers(damage)
 
 def update_led():
 
@@ -241,68 +373,309 @@ def update_led():
         return
 
     dt = datetime.datetime.now()
-    led.led_write (dt.strftime("%H%M"))
+    led_worker.show (dt.strftime("%H%M"))
+    ldebug ("LED: %s" % led_worker.stats())
+
+class telemetry_sender (object):
+
+    """fire-and-forget reports to getty. Sends never block: only changed
+       values are reported, and all reports of a TELEMETRY_BATCH interval
+       are coalesced into one send per command. Without a telemetry port,
+       reports go to getty's request port as ordinary requests on a DEALER
+       socket and the replies are discarded."""
+
+    def __init__(self, context, addr, push=False):
+
+        self.socket = context.socket(zmq.PUSH if push else zmq.DEALER)
+        self.push   = push
+        self.socket.setsockopt(zmq.SNDHWM, TELEMETRY_HWM)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect (addr)
+
+        self.pending    = {}   # cmd -> newest arg not sent yet
+        self.last       = {}   # cmd -> (arg, time) last sent
+
+        self.sent      = 0
+        self.unchanged = 0
+        self.dropped   = 0
+
+    def _changed(self, old, new):
+
+        if isinstance(new, (tuple, list)):
+            if not isinstance(old, (tuple, list)) or len(old) != len(new):
+                return True
+            for o, n in zip(old, new):
+                if self._changed(o, n):
+                    return True
+            return False
+
+        if isinstance(new, float) and isinstance(old, (int, float)):
+            return abs(new - old) >= TELEMETRY_DELTA
+
+        return old != new
+
+    def report(self, cmd, arg):
+
+        last = self.last.get(cmd)
+        if last is not None and not self._changed(last[0], arg) and \
+           time.time() - last[1] < TELEMETRY_REFRESH:
+            self.unchanged += 1
+            return
+
+        self.pending[cmd] = arg
+
+    def flush(self):
+        """send pending reports, called every TELEMETRY_BATCH ms"""
+
+        if not self.pending:
+            return
+        now = time.time()
+
+        # getty's replies to our DEALER requests
+        while not self.push:
+            try:
+                self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+        for cmd, arg in self.pending.items():
+
+            msg = json.dumps ([cmd, arg])
+
+            try:
+                if self.push:
+                    self.socket.send (msg, zmq.NOBLOCK)
+                else:
+                    self.socket.send_multipart (['', msg], zmq.NOBLOCK)
+            except zmq.Again:
+                # getty unreachable / not keeping up, the next change will be reported
+                self.dropped += 1
+                continue
+
+            self.last[cmd] = (arg, now)
+            self.sent += 1
+
+        self.pending.clear()
+
+        ldebug ("telemetry: %d sent, %d unchanged, %d dropped" % (self.sent, self.unchanged, self.dropped))
+
+class layout_worker (object):
+
+    """lays out DISPLAY_HTML pages on a background thread, so the main loop
+       keeps animating and presenting the current scene meanwhile"""
+
+    def __init__(self, hal, resources):
+
+        self.hal       = hal
+        self.resources = resources
+        # getty sends resource versions, so we may ask for changed ones only
+        self.versioned = resources.versioned()
+
+        self.cond   = threading.Condition()
+        self.job    = None   # newest (html, css, effect) not started yet
+        self.result = None   # (scene, effect) waiting for the main loop
+
+        self.dropped = 0     # jobs replaced before they were started
+
+        # written to when a result is ready, wakes up the main loop's poll()
+        self.wake_r, self.wake_w = os.pipe()
+
+        # zmq sockets must not be shared between threads
+        self.socket = hal_socket(context, "tcp://%s:%s" % (host_getty, port_getty))
+
+        self.thread = threading.Thread (target=self._layout_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _load_resource (self, resourcefn):
+
+        #
+        # a getty that versions its resources replies with
+        # {"version": v, "data": base64} instead of the plain base64 string,
+        # and to {"name": n, "version": v} with just {"version": v} if v is
+        # still current. Once we know it does, requests also carry
+        # "binary": true, which getty may answer with a two frame message,
+        # {"version": v} followed by the raw resource bytes.
+        #
+
+        entry = self.resources.get (resourcefn)
+        if entry is not None and entry[2] < RESOURCE_TTL:
+            return entry[1]
+
+        if self.versioned:
+            arg = { 'name': resourcefn, 'binary': True }
+            if entry is not None and entry[0] is not None:
+                arg['version'] = entry[0]
+        else:
+            arg = resourcefn
+
+        reply, parts = hal_comm_parts (self.socket, 'LOAD_RESOURCE', arg)
+
+        if reply is None:
+            if entry is not None:
+                linfo ("LOAD_RESOURCE %s: no reply from getty, using cached copy" % resourcefn)
+                return entry[1]
+            raise IOError ("LOAD_RESOURCE %s: no reply from getty" % resourcefn)
+
+        if isinstance(reply, dict):
+            self.versioned = True
+            version = reply.get('version')
+            if parts:
+                # raw bytes frame, no json string or base64 to decode
+                data = parts[0].bytes
+            elif not 'data' in reply and entry is not None:
+                self.resources.touch (resourcefn)
+                return entry[1]
+            else:
+                data = b64decode(reply['data'])
+        else:
+            version = None
+            data    = b64decode(reply)
+
+        self.resources.put (resourcefn, version, data)
+        ldebug ("LOAD_RESOURCE %s: %d bytes, resource cache %s" % (resourcefn, len(data), self.resources.stats()))
+
+        return data
+
+    def _layout_loop(self):
+
+        while True:
+
+            with self.cond:
+                while self.job is None:
+                    self.cond.wait()
+                html, css, effect = self.job
+                self.job = None
+
+            try:
+                scene = self.hal.layout (html, css, self._load_resource)
+            except:
+                traceback.print_exc()
+                lerror("Layout worker: EXCEPTION CAUGHT: %s" % traceback.format_exc())
+                continue
+
+            with self.cond:
+                self.result = (scene, effect)
+            os.write(self.wake_w, 'L')
+
+    def fileno(self):
+        return self.wake_r
+
+    def submit(self, html, css, effect):
+        """queue a page for layout, replaces a queued one not started yet"""
+        with self.cond:
+            if self.job is not None:
+                self.dropped += 1
+            self.job = (html, css, effect)
+            self.cond.notify()
+
+    def fetch(self):
+        """returns (scene, effect) of a finished layout or None"""
+        with self.cond:
+            res = self.result
+            self.result = None
+        return res
 
 class input_handler (object):
 
-    def _process_events(self):
+    """reads keys from the input device and forwards them to getty as
+       KEYPRESS requests on a DEALER socket, with up to KEYS_IN_FLIGHT
+       requests outstanding so typing is not serialized by round trips"""
+
+    def fileno(self):
+        return self.inp.fileno()
+
+    def process_events(self):
+        """handle pending input without blocking, returns True if a key was read"""
 
         try:
             key = self.inp.process_events()
 
             if key is not None:
-                hal_comm (self.socket, 'KEYPRESS', key)
+
+                if len(self.queue) < KEY_QUEUE_MAX:
+                    self.queue.append(key)
+                else:
+                    self.dropped += 1
+                    lerror ("Input handler: key queue full, %s dropped" % key)
+
+                self._send()
+                ldebug ("Input handler: INPUT EVENT HANDLED")
                 return True
         except:
             traceback.print_exc()
             lerror("Input handler: EXCEPTION CAUGHT: %s" % traceback.format_exc())
 
-
         return False
 
-    def _input_loop(self):
+    def _expire(self, now):
 
-        while True:
-            ldebug ("Input handler: _linput_loop iter")
-            if not self._process_events():
-                time.sleep(0.1)
-            else:
-                ldebug ("Input handler: INPUT EVENT HANDLED")
-            
+        for seq, (key, t) in self.inflight.items():
+            if now - t > KEY_TIMEOUT / 1000.0:
+                del self.inflight[seq]
+                self.lost += 1
+                lerror ("Input handler: no reply to KEYPRESS %s #%d, %d lost so far" % (key, seq, self.lost))
 
+    def _send(self):
 
-    def process_events(self):
-        """public function to be called regularly, in effect on non-threaded X11 only"""
+        now = time.time()
+        self._expire(now)
 
-        global USE_X11
+        while self.queue and len(self.inflight) < KEYS_IN_FLIGHT:
 
-        if not USE_X11:
-            return False   
+            key = self.queue.popleft()
+            self.seq += 1
 
-        return self._process_events()
-            
-    def __init__(self, inp):
+            # getty's REP socket echoes everything up to the empty delimiter
+            # back with its reply, so the sequence number travels with it
+            try:
+                self.socket.send_multipart ([str(self.seq), '', json.dumps (['KEYPRESS', key])], zmq.NOBLOCK)
+            except zmq.Again:
+                # getty not connected or not keeping up
+                self.dropped += 1
+                lerror ("Input handler: getty unreachable, %s dropped (%d so far)" % (key, self.dropped))
+                break
+
+            self.inflight[self.seq] = (key, now)
+
+    def process_replies(self):
+        """handle KEYPRESS replies without blocking, sends queued keys"""
+
+        while True:
 
-        global USE_X11
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+            entry = self.inflight.pop(int(frames[0]), None)
+            if entry is not None:
+                ldebug ("Input handler: KEYPRESS %s acknowledged after %.1f ms" % (entry[0], (time.time() - entry[1]) * 1000.0))
+
+        self._send()
+
+    def __init__(self, inp):
 
         self.inp = inp
 
+        self.seq      = 0
+        self.queue    = deque()   # keys waiting for a free slot
+        self.inflight = {}        # seq -> (key, time sent)
+        self.dropped  = 0
+        self.lost     = 0
+
         linfo("Input handler: connecting to server...")
         self.context = zmq.Context()
-        self.socket  = self.context.socket(zmq.REQ)
+        self.socket  = self.context.socket(zmq.DEALER)
+        # keep no keys inside zmq beyond the ones in flight, and none at all
+        # while getty is not connected, so no stale burst of keys arrives
+        # when it comes back
+        self.socket.setsockopt(zmq.SNDHWM, KEYS_IN_FLIGHT)
+        if hasattr(zmq, 'IMMEDIATE'):
+            self.socket.setsockopt(zmq.IMMEDIATE, 1)
+        self.socket.setsockopt(zmq.LINGER, 0)
         self.socket.connect ("tcp://%s:%s" % (host_getty, port_getty))
 
-        if USE_X11:
-            return
-        
-        # on rpi we handle input in separate thread for low latency
-
-        linfo("Input handler: running on pi -> starting input thread")
-
-        self.thread = threading.Thread (target=self._input_loop)
-        self.thread.setDaemon(True)
-        self.thread.start()
-
 
 #
 # main
@@ -324,10 +697,45 @@ host_getty  = config.get("zmq", "host")
 port_getty  = config.get("zmq", "port_getty")
 port_gettyp = config.get("zmq", "port_gettyp")
 
+conflate    = config.has_option("zmq", "conflate") and config.getboolean("zmq", "conflate")
+
+# optional PULL endpoint for telemetry, by default it goes to port_getty
+port_telemetry = None
+if config.has_option("zmq", "port_telemetry"):
+    port_telemetry = config.get("zmq", "port_telemetry")
+
 sensor_inside  = config.get("term", "sensor_inside")
 sensor_outside = config.get("term", "sensor_outside")
 term_location  = config.get("term", "location")
 
+# 1-wire sensors are read on background threads from now on
+start_sampling (sensor_inside, sensor_outside)
+
+resource_cache_size = RESOURCE_CACHE_SIZE
+if config.has_option("term", "resource_cache_kb"):
+    resource_cache_size = config.getint("term", "resource_cache_kb") * 1024
+
+resource_cache_dir = "%s/%s" % (home_path, ".hal_resources")
+if config.has_option("term", "resource_cache_dir"):
+    resource_cache_dir = expanduser(config.get("term", "resource_cache_dir"))
+
+page_cache_size = PAGE_CACHE_SIZE
+if config.has_option("term", "page_cache_kb"):
+    page_cache_size = config.getint("term", "page_cache_kb") * 1024
+
+# per command reply timeouts in ms
+if config.has_section("timeouts"):
+    for cmd, ms in config.items("timeouts"):
+        HAL_TIMEOUTS[cmd.upper()] = int(ms)
+
+# decode IR input in a separate process instead of a thread
+ir_process = config.has_option("term", "ir_process") and config.getboolean("term", "ir_process")
+
+# LIRC device, or a mode2 capture to replay
+ir_device = None
+if config.has_option("term", "ir_device"):
+    ir_device = config.get("term", "ir_device")
+
 # command line
 if len(sys.argv) == 2 and sys.argv[1] == '-d':
     set_loglevel(LOG_DEBUG)
@@ -342,7 +750,11 @@ if not USE_X11:
     from PiInput import PiInput
 
     gfx = PiGraphics ()
-    inp = PiInput ()
+    led_worker = led.LedWorker ()
+    if ir_device:
+        inp = PiInput (process = ir_process, device = ir_device)
+    else:
+        inp = PiInput (process = ir_process)
 
 else:
 
@@ -357,27 +769,34 @@ else:
 #
 
 context = zmq.Context()
-socket  = context.socket(zmq.REQ)
-socket.connect ("tcp://%s:%s" % (host_getty, port_getty))
+socket  = hal_socket(context, "tcp://%s:%s" % (host_getty, port_getty))
+
+# fire-and-forget telemetry
+
+if port_telemetry:
+    telemetry = telemetry_sender(context, "tcp://%s:%s" % (host_getty, port_telemetry), push=True)
+else:
+    telemetry = telemetry_sender(context, "tcp://%s:%s" % (host_getty, port_getty))
 
 # subscribe to broadcasts
 
 socket_sub = context.socket(zmq.SUB)
+# optionally let zmq keep just the newest message (needs libzmq >= 4)
+if conflate and hasattr(zmq, 'CONFLATE'):
+    socket_sub.setsockopt(zmq.CONFLATE, 1)
 socket_sub.connect ("tcp://%s:%s" % (host_getty, port_gettyp))
 
 # messages we're interested in
 socket_sub.setsockopt(zmq.SUBSCRIBE, 'DISPLAY_HTML')
 
-# set up poller so we can do timeouts when waiting for messages
-poller = zmq.Poller()
-poller.register(socket_sub, zmq.POLLIN)
 
 # 
 # setup rendering engine + display
 #
 
 linfo("Setup rendering engine + display ...")
-hal = HAL(gfx)
+hal = HAL(gfx, page_cache_size)
+layouter = layout_worker(hal, ResourceCache(resource_cache_dir, resource_cache_size))
 hal_comm (socket, 'TERM_BOOT', measure_temperatures(term_location, sensor_inside, sensor_outside))
 update_led()
 
@@ -391,38 +810,102 @@ inp_handler = input_handler(inp)
 # main loop
 #
 
+#
+# one poller for everything we wait on: broadcasts, input device / X
+# connection and finished layouts. It blocks until one of them has
+# something for us or the next animation frame (idle tick) is due.
+#
+
+#
+# periodic jobs, run at wall clock deadlines while no animation is running
+#
+
+def report_temperature():
+    telemetry.report ('TEMPERATURE', measure_temperatures(term_location, sensor_inside, sensor_outside))
+
+def log_stats():
+    ldebug ("scheduler: %s" % sched.stats())
+    ldebug ("page cache: %s" % hal.cache.stats())
+
+sched = Scheduler()
+sched.every ('led',         60.0,                     update_led, align=True, slack=1.0)
+sched.every ('temperature', TEMP_INTERVAL,            report_temperature)
+sched.every ('telemetry',   TELEMETRY_BATCH / 1000.0, telemetry.flush)
+sched.every ('page cache',  CACHE_INTERVAL,           lambda: hal.cache.expire(PAGE_CACHE_AGE))
+sched.every ('stats',       STATS_INTERVAL,           log_stats)
+
+poller = zmq.Poller()
+poller.register(socket_sub, zmq.POLLIN)
+poller.register(inp_handler.fileno(), zmq.POLLIN)
+poller.register(layouter.fileno(), zmq.POLLIN)
+poller.register(inp_handler.socket, zmq.POLLIN)
+
 linfo("Starting main loop.")
 
 quit = False
-counter = 0
+html_dropped = 0
+next_tick = monotonic()
 while not quit:
 
-    if not inp_handler.process_events():
-
-        # check for broadcast messages
-        socks = poller.poll(10)
-
-        if len(socks) > 0:
-            for s,e in socks:
-                cmd, data = s.recv().split(' ', 1)
-                data = json.loads(data)
-                ldebug("CMD is %s" % cmd)
-
-                if cmd == 'DISPLAY_HTML':
-                    ldebug("display html, counter=%d" % counter)
-                    job_html, job_css, job_effect = data
-                    try:
-                        hal.scene_reset (0)
-                        counter = 0 if job_effect == 1 else 32768
-                        hal.scene_html (job_html, job_css)
-                    except:
-                        traceback.print_exc()
- 
-        hal.scene_draw (counter)
-        counter += 1
-
-        if counter % LED_UPDATE == 0:
-            update_led()            
-        if counter % TEMP_UPDATE == 0:
-            hal_comm (socket, 'TEMPERATURE', measure_temperatures(term_location, sensor_inside, sensor_outside))
-
+    # Xlib may already have read events into its queue, those won't wake poll()
+    if USE_X11:
+        inp_handler.process_events()
+
+    timeout = max(0, int((next_tick - monotonic()) * 1000))
+    events  = dict(poller.poll(timeout))
+
+    if socket_sub in events:
+
+        msgs, dropped = drain_broadcasts (socket_sub)
+        html_dropped += dropped
+
+        for cmd, data in msgs:
+            data = json.loads(data)
+            ldebug("CMD is %s" % cmd)
+
+            if cmd == 'DISPLAY_HTML':
+                ldebug("display html, %d intermediate pages dropped" % (html_dropped + layouter.dropped))
+                job_html, job_css, job_effect = data
+                layouter.submit (job_html, job_css, job_effect)
+
+    if inp_handler.fileno() in events:
+        while inp_handler.process_events():
+            pass
+
+    if inp_handler.socket in events:
+        inp_handler.process_replies()
+
+    if layouter.fileno() in events:
+        os.read(layouter.fileno(), 4096)
+
+    # swap in a freshly laid out page
+    res = layouter.fetch()
+    if res is not None:
+        scene, effect = res
+        hal.scene_set (scene, effect == 1)
+        next_tick = monotonic()
+
+    if USE_X11 and inp.expose:
+        inp.expose = False
+        hal.invalidate()
+        next_tick = monotonic()
+
+    now = monotonic()
+    if now < next_tick:
+        continue
+
+    if not hal.idle:
+        hal.scene_draw (now)
+
+    sched.run (hal.idle)
+
+    # while idle, sleep until the next job is due. Frame ticks are on the
+    # monotonic clock, job deadlines on the wall clock: only the delay
+    # until the deadline carries over
+    if hal.idle:
+        next_tick = monotonic() + max(0.0, sched.next_deadline() - time.time())
+    else:
+        # keep the frame cadence, frames we fell behind on are dropped
+        next_tick += FRAME_TIME / 1000.0
+        if next_tick < now:
+            next_tick = now + FRAME_TIME / 1000.0
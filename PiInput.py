@@ -22,35 +22,44 @@
 # IR based Input events for RaspberryPi
 #
 
+import sys
 import time
-from pyirc2 import pyirc_nextcode
-
-REPEAT_DELAY = 500
+from pyirc2 import LircReader, LircProcess, LIRC_DEVICE
 
 class PiInput(object):
 
-    def __init__(self, name='PiInput'):
-        self.lastkey = ''
-        self.lasttime = 0
+    def __init__(self, name='PiInput', process=False, device=LIRC_DEVICE):
 
+        # decodes on its own thread (or in a child process if process is set),
+        # the main loop polls fileno() for us. device may also be a capture
+        # file (see pyirc2.capture) to replay
+        if process:
+            self.reader = LircProcess(device)
+        else:
+            self.reader = LircReader(device)
 
-    def process_events (self):
+        # time the last returned key's frame was read from the device
+        self.key_time = 0.0
 
-        # Read next code
-        key = pyirc_nextcode()
+    def fileno(self):
+        return self.reader.fileno()
 
-        #print "Got key: %s" % key
+    def process_events (self):
+        """non-blocking, returns the next decoded key or None"""
 
-        if key is not None:
+        while True:
 
-            t = int(time.time() * 1000) 
-            d = t - self.lasttime
+            ev = self.reader.get(False)
+            if ev is None:
+                break
 
-            if key != self.lastkey or d > REPEAT_DELAY:
+            key, repeat, t = ev
 
-                self.lastkey  = key
-                self.lasttime = t
-           
+            #print "Got key: %s repeat: %s" % (key, repeat)
+
+            # held keys are reported once
+            if not repeat:
+                self.key_time = t
                 return key
  
             #else:
@@ -61,11 +70,15 @@ class PiInput(object):
 
 if __name__ == "__main__":
 
-    inp = PiInput()
+    inp = PiInput(process = len(sys.argv) > 1 and sys.argv[1] == '-p')
 
     while True:
 
-        inp.next_event()
+        key = inp.process_events()
+        if key is not None:
+            print key
+
+        time.sleep(0.01)
 
         #time.sleep(1)
 
@@ -39,6 +39,10 @@ from egl.gl2ext import *
 
 import cairo
 
+# upload the whole texture instead of the damaged rectangles once these cover
+# more than this fraction of the texture (which is what a full upload sends)
+DAMAGE_FULL_UPLOAD = 0.5
+
 from egl import xlib_wrapper
 
 keymap = {
@@ -348,6 +352,9 @@ class X11Graphics(object):
         opengles.glViewport(0, 0, self.width, self.height);
         opengles.glClearColor ( ctypes.c_float(0.08) , ctypes.c_float(0.46) , ctypes.c_float(0.07) , ctypes.c_float(1.))   
 
+        # row-packing buffer for partial texture uploads, grown on demand
+        self.subimg    = (ctypes.c_ubyte * 0)()
+
         self.scene     = []
         self.coffset   = 0
 
@@ -359,11 +366,49 @@ class X11Graphics(object):
     def get_cairo_ctx (self):
         return self.ctx
        
-    def swap_buffers (self):
+    def _upload_texture (self, damage):
+
+        if damage is not None:
+            area = 0
+            for x, y, w, h in damage:
+                area += w * h
+            if area > DAMAGE_FULL_UPLOAD * self.texture_width * self.texture_height:
+                damage = None
+
+        if damage is None:
+            opengles.glTexImage2D(GL_TEXTURE_2D, 0, GL_BGRA_EXT, self.texture_width, self.texture_height, 0, GL_BGRA_EXT, GL_UNSIGNED_BYTE, self.img)
+            return
+
+        stride = self.texture_width * 4
+        base   = ctypes.addressof(self.img)
+
+        for x, y, w, h in damage:
+
+            if w == self.texture_width:
+                # full width rows are contiguous in the cairo surface already
+                opengles.glTexSubImage2D(GL_TEXTURE_2D, 0, 0, y, w, h, GL_BGRA_EXT, GL_UNSIGNED_BYTE, ctypes.c_void_p(base + y * stride))
+                continue
+
+            # GLES2 has no GL_UNPACK_ROW_LENGTH, so pack the rectangle's rows
+
+            rowlen = w * 4
+            if ctypes.sizeof(self.subimg) < rowlen * h:
+                self.subimg = (ctypes.c_ubyte * (rowlen * h))()
+
+            src = base + y * stride + x * 4
+            dst = ctypes.addressof(self.subimg)
+            for row in range(h):
+                ctypes.memmove(dst + row * rowlen, src + row * stride, rowlen)
+
+            opengles.glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, w, h, GL_BGRA_EXT, GL_UNSIGNED_BYTE, self.subimg)
+
+    def swap_buffers (self, damage=None):
+        """present the cairo surface. damage is a list of (x, y, w, h) device
+           rectangles that changed since the last call, None means everything"""
 
         xlib_wrapper.XLockDisplay(self.xDisplay)
 
-        opengles.glTexImage2D(GL_TEXTURE_2D, 0, GL_BGRA_EXT, self.texture_width, self.texture_height, 0, GL_BGRA_EXT, GL_UNSIGNED_BYTE, self.img)
+        self._upload_texture(damage)
 
         opengles.glClear(GL_COLOR_BUFFER_BIT)
 
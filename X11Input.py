@@ -119,6 +119,12 @@ class X11Input(object):
 
         self.xDisplay = xDisplay
 
+        # set when the window needs to be redrawn
+        self.expose   = False
+
+    def fileno(self):
+        return xlib_wrapper.XConnectionNumber(self.xDisplay)
+
     def process_events (self):
 
         xlib_wrapper.XLockDisplay(self.xDisplay)
@@ -140,6 +146,9 @@ class X11Input(object):
                 #norm_x    =  window_x / (window_width / 2.0)  
                 #updatePos = True  
 
+            if xev.type == xlib_wrapper.Expose:
+                self.expose = True
+
             if xev.type == xlib_wrapper.KeyPress:  
                 print "keypress2 state=%s button=%s" % (repr(xev.xkey.state), repr(xev.xkey.keycode))  
 
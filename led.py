@@ -25,6 +25,7 @@
 import spidev
 import time
 import datetime
+import threading
 
 # ASCII subset encoded for 7 segment display output:
 ASCII_OFFSET = 32
@@ -49,29 +50,83 @@ SPEED_HZ      = 7629
 DELAY_USEC    = 10
 BITS_PER_WORD = 8 
 
-def spi_sendrecv (byte):
+# zero bytes sent first to flush the display controller's state, header byte
+FLUSH_LEN     = 4
+HEADER        = 42
 
-    resp = spi.xfer([byte], SPEED_HZ, DELAY_USEC, BITS_PER_WORD)
-    #print "%d -> %d" % (byte, resp[0])
+def led_frame (s):
+    """flush + header + 4 segment codes for string s"""
 
+    frame = [0] * FLUSH_LEN
+    frame.append(HEADER)
+
+    for i in range(4):
+        frame.append(code_table[ord(s[i])-ASCII_OFFSET])
+
+    return frame
 
 def led_write (s):
 
-    #
-    # flush state
-    #
+    # one transaction for the whole frame instead of one per byte
+    resp = spi.xfer2(led_frame(s), SPEED_HZ, DELAY_USEC, BITS_PER_WORD)
 
-    for i in range(4):
-        spi_sendrecv(0)
-     
-    # header
-    spi_sendrecv(42) 
+class LedWorker(object):
 
-    for i in range(4):
+    """writes strings to the LED on a background thread, so the slow SPI
+       transfer never holds up the caller. Only the newest string is
+       written and a string already on the display is not sent again."""
+
+    def __init__(self):
+
+        self.cond    = threading.Condition()
+        self.pending = None   # newest string not written yet
+        self.shown   = None   # string on the display
+
+        self.updates = 0
+        self.skipped = 0
+        self.total   = 0.0    # seconds spent in led_write
+        self.last    = 0.0    # seconds the last update took
+
+        self.thread = threading.Thread (target=self._write_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def show(self, s):
+
+        with self.cond:
+            if s == self.shown and self.pending is None:
+                self.skipped += 1
+                return
+            self.pending = s
+            self.cond.notify()
+
+    def _write_loop(self):
+
+        while True:
+
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                s = self.pending
+                self.pending = None
+
+            if s == self.shown:
+                continue
+
+            t0 = time.time()
+            led_write (s)
+            dt = time.time() - t0
 
-        code = code_table[ord(s[i])-ASCII_OFFSET]
+            with self.cond:
+                self.shown    = s
+                self.updates += 1
+                self.total   += dt
+                self.last     = dt
 
-        spi_sendrecv(code)
+    def stats(self):
+        with self.cond:
+            return "%d updates, %d unchanged, last %.1f ms, avg %.1f ms" % \
+                   (self.updates, self.skipped, self.last * 1000.0, self.total * 1000.0 / max(self.updates, 1))
 
 spi = spidev.SpiDev()
 
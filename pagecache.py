@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# LRU cache of laid out scenes so re-broadcast pages skip robinson
+#
+
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+
+import cairo
+
+def page_key(html, css, width):
+    """cache key for a page laid out at the given viewport width"""
+
+    h = hashlib.sha1()
+    for s in (html, css):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        h.update(s)
+        h.update('\0')
+    h.update(str(width))
+
+    return h.digest()
+
+def scene_size(scene):
+    """rough estimate of the memory held by a recorded scene in bytes"""
+
+    size = 0
+
+    for t in scene:
+        size += 56 + 8 * len(t)
+        for a in t[1:]:
+            if isinstance(a, basestring):
+                size += 40 + len(a)
+            elif isinstance(a, cairo.ImageSurface):
+                size += a.get_stride() * a.get_height()
+
+    return size
+
+class PageCache(object):
+
+    """used by the layout thread, expire() is called from the main loop"""
+
+    def __init__(self, max_size):
+
+        self.max_size = max_size   # memory budget in bytes, 0 disables the cache
+        self.size     = 0
+        self.entries  = OrderedDict()   # key -> (scene, size, last use), oldest first
+        self.lock     = threading.Lock()
+
+        self.hits     = 0
+        self.misses   = 0
+        self.expired  = 0
+
+    def get(self, key):
+
+        with self.lock:
+
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # move to the most recently used end
+            self.entries[key] = (entry[0], entry[1], time.time())
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, key, scene):
+
+        size = scene_size(scene)
+        if size > self.max_size:
+            return
+
+        with self.lock:
+
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            while self.entries and self.size + size > self.max_size:
+                k, e = self.entries.popitem(last=False)
+                self.size -= e[1]
+
+            self.entries[key] = (scene, size, time.time())
+            self.size += size
+
+    def expire(self, max_age):
+        """drop pages not used for max_age seconds"""
+
+        limit = time.time() - max_age
+
+        with self.lock:
+            # least recently used first, stop at the first one still in use
+            for k in self.entries.keys():
+                e = self.entries[k]
+                if e[2] >= limit:
+                    break
+                del self.entries[k]
+                self.size -= e[1]
+                self.expired += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return "%d pages, %d/%d KB, %d hits, %d misses, %d expired" % \
+               (len(self.entries), self.size / 1024, self.max_size / 1024, self.hits, self.misses, self.expired)
+
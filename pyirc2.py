@@ -29,25 +29,81 @@
 #   SIEMENS frame:  1 start bit + 22 data bits + no stop bit
 #   SIEMENS data:   13 address bits + 1 repeat bit + 7 data bits + 1 unknown bit
 #
+#   RUWIDO frame:   1 start bit + 18 data bits + no stop bit
+#   RUWIDO data:    9 address bits + 8 data bits + 1 unknown bit
+#
+#   the unknown bit is the inverted last data bit, we use it as a check bit.
+#   The Merlin keyboard has no repeat bit, a frame following the previous
+#   one by less than GAP_LEN is a held key.
+#
 #   start  bit           data "0":            data "1":
 #   -------_______       _______-------       -------_______
 #    250us  250us         250us  250us         250us  250us
 
 
+import os
+import sys
+import time
+import atexit
+import ctypes
+import signal
+import random
+import errno
+import fcntl
+import select
+import subprocess
+import threading
+import Queue
+from array import array
+
 VERBOSE = False
 
 STATE_IDLE      = 2
 STATE_DATA      = 1
-STATE_GAP       = 3
 
 MAX_PULSE_LEN   = 600
 SHORT_PULSE_LEN = 250
 
+# pulses/spaces at least this long quantize to a long symbol: halfway
+# between the ~200us short and ~400us long half bits
+LONG_PULSE_MIN  = SHORT_PULSE_LEN + SHORT_PULSE_LEN / 5
+PULSE_SYMBOLS   = 'SL'
+
+# frame layouts by number of data bits: (address bits, repeat bits, command bits),
+# followed by the check bit
+FRAME_LAYOUTS   = { 18: (  9, 0, 8 ),     # RUWIDO
+                    22: ( 13, 1, 7 ) }    # SIEMENS
+
+# max relative deviation from a recorded code in the template match
+CODE_TOLERANCE  = 0.4
+
 GAP_LEN         = 50000
 
 LIRC_DEVICE='/dev/lirc0'
 
-state = STATE_IDLE
+# file name extension of raw mode2 captures
+CAPTURE_EXT = '.mode2'
+
+# mode2 records: 24 bits pulse/space length in us, 8 bits type
+LIRC_RECORD_LEN = 4
+LIRC_LENGTH_MASK = 0x00ffffff
+
+# seconds to wait before reopening the device after a read error
+REOPEN_DELAY     = 5
+
+# seconds before a crashed decoder process is restarted, doubled up to
+# RESPAWN_MAX_DELAY while it keeps crashing
+RESPAWN_DELAY     = 1
+RESPAWN_MAX_DELAY = 60
+
+# prctl() option: signal sent to a process when its parent dies
+PR_SET_PDEATHSIG  = 1
+
+# bytes per read(), the driver hands us whatever it has buffered up to this
+LIRC_READ_SIZE   = 4096
+
+# array typecode of an unsigned 32 bit record
+LIRC_RECORD_TYPE = 'I' if array('I').itemsize == LIRC_RECORD_LEN else 'L'
 
 codes = {
     'KEY_ENTER': [ 200 , 400 , 200 , 200 , 200 , 200 ,
@@ -558,8 +614,595 @@ codes = {
     }
 
 
+def decode_frame(data):
+    """Manchester decode of one frame of pulse/space lengths (starting with
+       a pulse) into (address, repeat, command), None if it is no valid frame"""
+
+    bits  = 0
+    nbits = 0
+    first = -1    # level of the first half of the current bit, -1 between bits
+    level = 1
+
+    for l in data:
+
+        for h in range(2 if l >= LONG_PULSE_MIN else 1):
+
+            if first < 0:
+                first = level
+            elif first == level:
+                # no transition in the middle of the bit
+                return None
+            else:
+                bits   = (bits << 1) | first
+                nbits += 1
+                first  = -1
+
+        level ^= 1
+
+    # the low half of a trailing "1" is swallowed by the gap
+    if first == 1:
+        bits   = (bits << 1) | 1
+        nbits += 1
+    elif first == 0:
+        return None
+
+    layout = FRAME_LAYOUTS.get(nbits - 1)
+    if layout is None:
+        return None
+
+    abits, rbits, cbits = layout
+
+    check    = bits & 1
+    bits   >>= 1
+    command  = bits & ((1 << cbits) - 1)
+    bits   >>= cbits
+    repeat   = bits & ((1 << rbits) - 1)
+    bits   >>= rbits
+    address  = bits & ((1 << abits) - 1)
+    bits   >>= abits
+
+    if bits != 1 or check == command & 1:
+        return None
+
+    return address, repeat, command
+
+def _build_key_table():
+
+    table = {}
+    dups  = set()
+
+    for k in codes:
+
+        frame = decode_frame(codes[k])
+        if frame is None:
+            continue
+
+        address, repeat, command = frame
+        if (address, command) in table:
+            dups.add((address, command))
+        table[(address, command)] = k
+
+    for ac in dups:
+        del table[ac]
+
+    return table
+
+# (address, command) -> key, built once from the recorded codes
+key_table = _build_key_table()
+
+def pulse_signature(data):
+    """quantize pulse/space lengths into a short/long symbol string"""
+    return ''.join([PULSE_SYMBOLS[l >= LONG_PULSE_MIN] for l in data])
+
+def _build_index():
+
+    index = {}
+    dups  = set()
+
+    for k in codes:
+        sig = pulse_signature(codes[k])
+        if sig in index:
+            dups.add(sig)
+        index[sig] = k
+
+    # ambiguous signatures are left to the template match
+    for sig in dups:
+        del index[sig]
+
+    return index
+
+# signature -> key, built once from the recorded codes
+code_index = _build_index()
+
+# templates grouped by pulse count: length -> [ (key, code, lower, upper) ]
+def _build_templates():
+
+    templates = {}
+
+    for k in codes:
+        code = codes[k]
+        lower = [c - c * CODE_TOLERANCE for c in code]
+        upper = [c + c * CODE_TOLERANCE for c in code]
+        templates.setdefault(len(code), []).append((k, code, lower, upper))
+
+    return templates
+
+code_templates = _build_templates()
+
+def _print_match(k, code, data):
+    l = len(code)
+    print "MATCH! %s data: %d, code: %d" % (k, len(data), len(code))
+    print "data: ",
+    for i in range(l):
+        print "%4d" % data[i],
+    print
+    print "code: ",
+    for i in range(l):
+        print "%4d" % code[i],
+    print
+    print "match ",
+    for i in range(l):
+        diff = float(abs (code[i] - data[i])) / float(code[i])
+        print "%4.2f" % diff,
+    print
+
+def match_template(data):
+    """tolerant match of data against every recorded code of the same length"""
+
+    for k, code, lower, upper in code_templates.get(len(data), ()):
+
+        matched = True
+
+        for i in range(len(code)):
+            if data[i] < lower[i] or data[i] > upper[i]:
+                matched = False
+                break
+
+        if matched:
+            if VERBOSE:
+                _print_match(k, code, data)
+            return k
+
+    return None
+
 def decode_data(data):
 
+    k = code_index.get(pulse_signature(data))
+    if k is not None:
+        if VERBOSE:
+            _print_match(k, codes[k], data)
+        return k
+
+    return match_template(data)
+
+def decode_key(data):
+    """(key, repeat bit) of one frame, key is None if it is not recognized"""
+
+    frame = decode_frame(data)
+    if frame is not None:
+        address, repeat, command = frame
+        key = key_table.get((address, command))
+        if key is not None:
+            return key, bool(repeat)
+
+    # distorted frame, try the tolerant match against the recordings
+    return decode_data(data), False
+
+class IRDecoder(object):
+
+    """incremental decoder: feed() it pulse/space lengths as they are read
+       from the device, it returns (key, repeat) once a complete frame is seen"""
+
+    def __init__(self):
+        self.state   = STATE_IDLE
+        self.data    = []
+        self.last    = None    # key of the previous frame
+        self.follows = False   # the current frame follows it within GAP_LEN
+
+    def _frame(self):
+
+        key, repeat = decode_key(self.data)
+        if key is None:
+            return None
+
+        repeat = repeat or (self.follows and key == self.last)
+        self.last = key
+
+        if VERBOSE:
+            print "FRAME %s repeat=%s" % (key, repeat)
+
+        return key, repeat
+
+    def feed(self, length):
+
+        if length > MAX_PULSE_LEN:
+
+            res = None
+            if self.state == STATE_DATA:
+                res = self._frame()
+
+            if VERBOSE:
+                print "GAP %d" % length
+
+            self.follows = length < GAP_LEN
+            self.state   = STATE_IDLE
+            self.data    = []
+            return res
+
+        if self.state == STATE_IDLE:
+            self.data  = [ length ]
+            self.state = STATE_DATA
+
+        elif self.state == STATE_DATA:
+
+            self.data.append(length)
+
+        if VERBOSE:
+            print "%8d state=%d %s" % (length, self.state, repr(self.data))
+
+        return None
+
+def read_events(fd, decoder):
+
+    """generator: decodes the LIRC records read from fd, yields
+       (key, repeat, time) with the time the frame's last record was read"""
+
+    partial = ''
+
+    while True:
+
+        # blocks until the driver has at least one record for us
+        try:
+            data = os.read(fd, LIRC_READ_SIZE)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        t    = time.time()
+        if not data:
+            # end of a replayed capture: the gap after its last frame may be missing
+            ev = decoder.feed(GAP_LEN)
+            if ev is not None:
+                yield ev[0], ev[1], t
+            return
+
+        buf = partial + data
+
+        n = len(buf) - len(buf) % LIRC_RECORD_LEN
+        partial = buf[n:]
+
+        records = array(LIRC_RECORD_TYPE)
+        records.fromstring(buf[:n])
+
+        for r in records:
+            ev = decoder.feed(r & LIRC_LENGTH_MASK)
+            if ev is not None:
+                yield ev[0], ev[1], t
+
+class LircReader(object):
+
+    """keeps the LIRC device open and decodes it on a background thread.
+       Decoded (key, repeat, time) tuples are queued for get(); for each a
+       byte is written to a pipe so a poll() based loop can wait on fileno()."""
+
+    def __init__(self, device=LIRC_DEVICE):
+
+        self.device  = device
+        self.fd      = None     # opened by the reader thread
+        self.decoder = IRDecoder()
+        self.keys    = Queue.Queue()
+
+        self.wake_r, self.wake_w = os.pipe()
+        fcntl.fcntl(self.wake_r, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        self.thread = threading.Thread (target=self._read_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def fileno(self):
+        return self.wake_r
+
+    def _reopen(self, delay):
+
+        """(re)opens the device after delay seconds, then every REOPEN_DELAY
+           seconds until it is there (lirc module not loaded yet, ...)"""
+
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+        while True:
+            time.sleep(delay)
+            try:
+                self.fd = os.open(self.device, os.O_RDONLY)
+                break
+            except OSError, e:
+                print "LircReader: failed to open %s: %s, retrying in %d s" % (self.device, e, REOPEN_DELAY)
+                delay = REOPEN_DELAY
+
+        self.decoder = IRDecoder()
+        print "LircReader: %s opened" % self.device
+
+    def _read_loop(self):
+
+        delay = 0
+
+        while True:
+
+            self._reopen(delay)
+
+            try:
+                for ev in read_events(self.fd, self.decoder):
+                    self.keys.put(ev)
+                    os.write(self.wake_w, 'K')
+
+                # end of a replayed capture
+                return
+
+            except (OSError, IOError), e:
+                print "LircReader: reading %s failed: %s, reopening in %d s" % (self.device, e, REOPEN_DELAY)
+
+            delay = REOPEN_DELAY
+
+    def get(self, block=True):
+        """next (key, repeat, time), None if block is False and there is none"""
+
+        if not block:
+            try:
+                os.read(self.wake_r, LIRC_READ_SIZE)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+        try:
+            return self.keys.get(block)
+        except Queue.Empty:
+            return None
+
+def serve(device=LIRC_DEVICE, out=1):
+
+    """decoder process main loop: one "key repeat time" line per frame to fd out.
+       The end of a replayed capture is reported as an "END" line."""
+
+    fd = os.open(device, os.O_RDONLY)
+
+    for key, repeat, t in read_events(fd, IRDecoder()):
+        os.write(out, "%s %d %.6f\n" % (key, repeat, t))
+
+    os.write(out, "END\n")
+
+try:
+    _prctl = ctypes.CDLL('libc.so.6', use_errno=True).prctl
+except (OSError, AttributeError):
+    _prctl = None
+
+def _die_with_parent():
+
+    # runs in the child between fork and exec: have the kernel terminate
+    # the decoder if the terminal goes away without cleaning up (crash, kill -9)
+    if _prctl is not None:
+        _prctl (PR_SET_PDEATHSIG, signal.SIGTERM)
+
+class LircProcess(LircReader):
+
+    """same interface as LircReader, but the device is read and decoded
+       by a child process (python pyirc2.py serve) so pulse timing does not
+       compete for the GIL with rendering. A thread here just waits for the
+       child's key lines, queues them and restarts the child if it dies."""
+
+    def __init__(self, device=LIRC_DEVICE):
+
+        self.device   = device
+        self.script   = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        self.keys     = Queue.Queue()
+        self.proc     = None
+        self.stopping = False
+
+        self.wake_r, self.wake_w = os.pipe()
+        fcntl.fcntl(self.wake_r, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        # the child holds the device open, it must not outlive us
+        atexit.register(self.stop)
+
+        self.thread = threading.Thread (target=self._read_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """terminates the decoder process, it is not restarted anymore"""
+
+        self.stopping = True
+
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.terminate()
+                proc.wait()
+            except OSError:
+                pass
+
+    def _read_loop(self):
+
+        delay = RESPAWN_DELAY
+
+        while not self.stopping:
+
+            proc = subprocess.Popen ([sys.executable, self.script, 'serve', self.device],
+                                     stdout=subprocess.PIPE, close_fds=True,
+                                     preexec_fn=_die_with_parent)
+            self.proc = proc
+            started   = time.time()
+            finished = False
+
+            for l in iter(proc.stdout.readline, ''):
+
+                if l == 'END\n':
+                    finished = True
+                    break
+
+                key, repeat, t = l.split()
+                self.keys.put((key, repeat == '1', float(t)))
+                os.write(self.wake_w, 'K')
+
+            status = proc.wait()
+
+            if self.stopping:
+                return
+
+            if finished:
+                print "LircProcess: end of %s" % self.device
+                return
+
+            # a child that ran for a while gets restarted quickly again
+            if time.time() - started > RESPAWN_MAX_DELAY:
+                delay = RESPAWN_DELAY
+
+            print "LircProcess: decoder process exited with %d, restarting in %d s" % (status, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, RESPAWN_MAX_DELAY)
+
+_reader = None
+
+def pyirc_nextcode():
+
+    """blocking read of the next key press (repeats skipped) from LIRC_DEVICE"""
+
+    global _reader
+
+    if _reader is None:
+        _reader = LircReader()
+
+    while True:
+        key, repeat, t = _reader.get()
+        if not repeat:
+            return key
+
+
+#
+# capture / replay of raw mode2 records
+#
+#   python pyirc2.py capture DIR [KEY ...]    records DIR/KEY.mode2 per key
+#   python pyirc2.py replay  DIR|FILE ...     decodes captures, per key stats
+#
+# a capture can also be used in place of LIRC_DEVICE ([term] ir_device)
+#
+
+def capture(path, keys, device=LIRC_DEVICE):
+
+    """dumps the raw records read from device to path/<key>.mode2 while the
+       user presses key, enter moves on to the next key"""
+
+    fd = os.open(device, os.O_RDONLY)
+
+    for key in keys:
+
+        print "press %s a few times, then hit enter" % key
+
+        out = open(os.path.join(path, key + CAPTURE_EXT), 'wb')
+
+        while True:
+            r, w, x = select.select([fd, sys.stdin], [], [])
+            if fd in r:
+                out.write(os.read(fd, LIRC_READ_SIZE))
+            if sys.stdin in r:
+                sys.stdin.readline()
+                break
+
+        out.close()
+
+    os.close(fd)
+
+def read_capture(fn):
+    """pulse/space lengths of a capture file"""
+
+    f = open(fn, 'rb')
+    buf = f.read()
+    f.close()
+
+    records = array(LIRC_RECORD_TYPE)
+    records.fromstring(buf[:len(buf) - len(buf) % LIRC_RECORD_LEN])
+
+    return [r & LIRC_LENGTH_MASK for r in records]
+
+def replay_stats(key, lengths):
+
+    """decodes lengths captured while key was pressed, returns
+       (frames, wrong, missed, decode time, max frame latency)"""
+
+    decoder = IRDecoder()
+
+    frames = wrong = missed = 0
+    total  = 0.0
+    worst  = 0.0
+    frame  = 0.0    # decode time spent on the current frame
+
+    for l in lengths + [ GAP_LEN ]:
+
+        ends = l > MAX_PULSE_LEN and decoder.state == STATE_DATA
+
+        t0 = time.time()
+        ev = decoder.feed(l)
+        dt = time.time() - t0
+
+        total += dt
+        frame += dt
+
+        if not ends:
+            if l > MAX_PULSE_LEN:
+                frame = 0.0
+            continue
+
+        frames += 1
+        worst   = max(worst, frame)
+        frame   = 0.0
+
+        if ev is None:
+            missed += 1
+        elif ev[0] != key:
+            wrong += 1
+
+    return frames, wrong, missed, total, worst
+
+def replay(paths):
+
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(sorted([os.path.join(p, fn) for fn in os.listdir(p) if fn.endswith(CAPTURE_EXT)]))
+        else:
+            files.append(p)
+
+    sum_frames = sum_bad = 0
+    sum_time   = 0.0
+
+    for fn in files:
+
+        key = os.path.basename(fn)[:-len(CAPTURE_EXT)]
+
+        frames, wrong, missed, total, worst = replay_stats(key, read_capture(fn))
+
+        sum_frames += frames
+        sum_bad    += wrong + missed
+        sum_time   += total
+
+        print "%-16s %5d frames %8.0f keys/s  latency %6.1f us avg %6.1f us max  %3d wrong %3d missed (%5.1f%%)" % \
+              (key, frames, frames / max(total, 1e-9), total * 1e6 / max(frames, 1), worst * 1e6,
+               wrong, missed, 100.0 * (wrong + missed) / max(frames, 1))
+
+    print "%-16s %5d frames %8.0f keys/s  %d misdetected (%.1f%%)" % \
+          ('total', sum_frames, sum_frames / max(sum_time, 1e-9), sum_bad, 100.0 * sum_bad / max(sum_frames, 1))
+
+#
+# decoder benchmark: python pyirc2.py bench [rounds]
+#
+
+def _decode_scan(data):
+
+    # the original linear scan over all codes, kept for comparison
+
     for k in codes:
 
         code = codes[k]
@@ -572,93 +1215,71 @@ def decode_data(data):
 
         for i in range(l):
             diff = float(abs (code[i] - data[i])) / float(code[i])
-            if diff > 0.4:
+            if diff > CODE_TOLERANCE:
                 matched = False
                 break
 
         if matched:
-            if VERBOSE:
-                print "MATCH! %s data: %d, code: %d" % (k, len(data), len(code))
-                print "data: ",
-                for i in range(l):
-                    print "%4d" % data[i],
-                print
-                print "code: ",
-                for i in range(l):
-                    print "%4d" % code[i],
-                print
-                print "match ",
-                for i in range(l):
-                    diff = float(abs (code[i] - data[i])) / float(code[i])
-                    print "%4.2f" % diff,
-                print
             return k
 
     return None
 
-def pyirc_nextcode():
+def _bench_frames(rounds, jitter):
 
-    global state
+    # the recorded codes with every pulse/space off by up to +-jitter
 
-    code = None
-    data = []
+    rnd = random.Random(42)
 
-    with open(LIRC_DEVICE, 'rb') as f:
+    frames = []
+    for r in range(rounds):
+        for k in codes:
+            frames.append((k, [int(l * rnd.uniform(1.0 - jitter, 1.0 + jitter)) for l in codes[k]]))
 
-        while True:
+    return frames
 
-            length = 0
+def _bench(name, decode, frames):
 
-            length  = ord(f.read(1))
-            length |= ord(f.read(1)) << 8
-            length |= ord(f.read(1)) << 16
-            ctrl    = ord(f.read(1))
-     
-            if length > MAX_PULSE_LEN:
+    t0 = time.time()
+    wrong = 0
+    for k, data in frames:
+        if decode(data) != k:
+            wrong += 1
+    t = time.time() - t0
 
-                if state == STATE_GAP:
-                    if length < GAP_LEN:
-                        continue
-                elif state == STATE_DATA:
-                    state = STATE_GAP
+    print "%-6s %6.2f us/key, %d/%d misdetected" % (name, t * 1e6 / len(frames), wrong, len(frames))
 
-                    code = decode_data(data)
+if __name__ == "__main__":
 
-                    if VERBOSE:
-                        print "GAP"
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
 
-                    if code is not None:
-                        break
+        rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 100
 
-                    continue 
+        for jitter in (0.0, 0.15, 0.3):
+            frames = _bench_frames(rounds, jitter)
+            print "%d frames, jitter %d%%:" % (len(frames), jitter * 100)
+            _bench ('scan',  _decode_scan, frames)
+            _bench ('index', decode_data,  frames)
+            _bench ('frame', lambda data: decode_key(data)[0], frames)
 
-                if VERBOSE:
-                    print "IDLE"
-                state = STATE_IDLE
-                data  = 0
-                nbits = 0
-                continue
+        sys.exit(0)
 
-            if state == STATE_GAP:
-                continue
-
-            if state == STATE_IDLE:
-                data  = [ length ]
-                state = STATE_DATA
+    if len(sys.argv) > 2 and sys.argv[1] == 'capture':
 
-            elif state == STATE_DATA:
+        capture(sys.argv[2], sys.argv[3:] or sorted(codes))
 
-                data.append(length)
+        sys.exit(0)
 
-            if VERBOSE:
-                print "%d: %8d state=%d %s" % (ctrl, length, state, repr(data))
+    if len(sys.argv) > 2 and sys.argv[1] == 'replay':
 
+        replay(sys.argv[2:])
 
-    return code
+        sys.exit(0)
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
 
-if __name__ == "__main__":
+        serve(sys.argv[2] if len(sys.argv) > 2 else LIRC_DEVICE)
 
+        sys.exit(0)
 
     while True:
 
@@ -666,5 +1287,3 @@ if __name__ == "__main__":
 
         print code
 
-
-
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# cache for LOAD_RESOURCE: in memory LRU in front of an on-disk store
+#
+# the store keeps each distinct content once, in a file named by its sha1
+# holding just the raw bytes (so it can be mmap()ed), plus an index
+# mapping resource names to (server version, sha1). Only resources with a
+# server version are persisted, as only those can be revalidated later.
+#
+
+import os
+import time
+import json
+import hashlib
+from collections import OrderedDict
+
+INDEX_NAME = 'index.json'
+
+class ResourceCache(object):
+
+    def __init__(self, path, max_size):
+
+        self.path     = path
+        self.max_size = max_size        # memory budget in bytes
+        self.size     = 0
+        self.entries  = OrderedDict()   # name -> (version, data, time fetched), oldest first
+        self.index    = {}              # name -> (version, sha1) on disk
+
+        self.hits     = 0
+        self.disk     = 0
+        self.misses   = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        try:
+            with open(os.path.join(path, INDEX_NAME)) as f:
+                self.index = dict([(k, tuple(v)) for k, v in json.load(f).items()])
+        except (IOError, ValueError):
+            self.index = {}
+
+    def _file(self, digest):
+        return os.path.join(self.path, digest)
+
+    def _remember(self, name, version, data, t):
+
+        old = self.entries.pop(name, None)
+        if old is not None:
+            self.size -= len(old[1])
+
+        if len(data) > self.max_size:
+            return
+
+        while self.entries and self.size + len(data) > self.max_size:
+            k, e = self.entries.popitem(last=False)
+            self.size -= len(e[1])
+
+        self.entries[name] = (version, data, t)
+        self.size += len(data)
+
+    def get(self, name):
+        """(version, data, age in seconds) of a cached resource or None.
+           Resources loaded from disk have an infinite age: they have to be
+           revalidated with the server before they may be used as is."""
+
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.entries[name] = entry
+            self.hits += 1
+            return entry[0], entry[1], time.time() - entry[2]
+
+        ondisk = self.index.get(name)
+        if ondisk is not None:
+            try:
+                with open(self._file(ondisk[1]), 'rb') as f:
+                    data = f.read()
+                self.disk += 1
+                self._remember (name, ondisk[0], data, 0.0)
+                return ondisk[0], data, float('inf')
+            except IOError:
+                del self.index[name]
+
+        self.misses += 1
+        return None
+
+    def touch(self, name):
+        """the server confirmed the cached version is current"""
+
+        entry = self.entries.get(name)
+        if entry is not None:
+            self.entries[name] = (entry[0], entry[1], time.time())
+
+    def put(self, name, version, data):
+
+        self._remember (name, version, data, time.time())
+
+        if version is None:
+            return
+
+        digest = hashlib.sha1(data).hexdigest()
+        fn = self._file(digest)
+
+        try:
+            if not os.path.exists(fn):
+                tmp = fn + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp, fn)
+
+            old = self.index.get(name)
+            self.index[name] = (version, digest)
+
+            # drop content no other name refers to anymore
+            if old is not None and old[1] != digest and \
+               not old[1] in [d for v, d in self.index.values()]:
+                os.unlink(self._file(old[1]))
+
+            self._write_index()
+
+        except (IOError, OSError), e:
+            print "resource cache: failed to store %s: %s" % (name, e)
+
+    def _write_index(self):
+
+        tmp = os.path.join(self.path, INDEX_NAME + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.rename(tmp, os.path.join(self.path, INDEX_NAME))
+
+    def versioned(self):
+        """True if the server handed out versions before"""
+        return len(self.index) > 0
+
+    def stats(self):
+        return "%d in memory (%d/%d KB), %d on disk, %d hits, %d from disk, %d misses" % \
+               (len(self.entries), self.size / 1024, self.max_size / 1024, len(self.index),
+                self.hits, self.disk, self.misses)
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# recorded HAL scenes compiled into a compact display program
+#
+# run "python scene.py [n]" for a dispatch overhead benchmark
+#
+
+import math
+import time
+import sys
+from array import array
+
+import cairo
+
+SCMD_SET_SOURCE_RGBA    =  1
+SCMD_PAINT              =  2
+SCMD_SELECT_FONT_FACE   =  3
+SCMD_SET_FONT_SIZE      =  4
+SCMD_MOVE_TO            =  5
+SCMD_SHOW_TEXT          =  6
+SCMD_REL_LINE_TO        =  7
+SCMD_CLOSE_PATH         =  8
+SCMD_FILL               =  9
+SCMD_SET_LINE_WIDTH     = 10
+SCMD_SAVE               = 11
+SCMD_RESTORE            = 12
+SCMD_SET_SOURCE         = 13
+SCMD_CLIP               = 14
+SCMD_SET_SOURCE_SURFACE = 15
+SCMD_RECTANGLE          = 16   # produced by optimize_scene()
+
+SCMD_MAX                = 16
+
+INF = float('inf')
+
+class SceneRecorder(object):
+
+    """cairo context lookalike handed to robinson's render(), records the
+       drawing calls as a scene. Font metrics come from measure (see
+       textmeasure.TextMeasure)."""
+
+    def __init__(self, measure):
+
+        self.scene     = []
+        self.measure   = measure
+
+        # current font, cairo's defaults initially
+        self.font_face = 'sans-serif'
+        self.font_size = 10.0
+
+    def set_source_rgba (self, r, g, b, a):
+        self.scene.append ( (SCMD_SET_SOURCE_RGBA, r, g, b, a) )
+
+    def paint (self):
+        self.scene.append ( (SCMD_PAINT, ) )
+
+    def select_font_face (self, font_face):
+        self.font_face = font_face
+        self.scene.append ( (SCMD_SELECT_FONT_FACE, font_face) )
+
+    def set_font_size (self, font_size):
+        self.font_size = font_size
+        self.scene.append ( (SCMD_SET_FONT_SIZE, font_size) )
+
+    def set_line_width (self, w):
+        self.scene.append ( (SCMD_SET_LINE_WIDTH, w) )
+
+    def move_to (self, x, y):
+        self.scene.append ( (SCMD_MOVE_TO, x, y) )
+
+    def show_text (self, txt):
+        self.scene.append ( (SCMD_SHOW_TEXT, txt) )
+
+    def rel_line_to (self, x, y):
+        self.scene.append ( (SCMD_REL_LINE_TO, x, y) )
+
+    def close_path (self):
+        self.scene.append ( (SCMD_CLOSE_PATH,) )
+
+    def fill (self):
+        self.scene.append ( (SCMD_FILL,) )
+
+    def rectangle (self, x, y, w, h):
+        self.move_to (x, y)
+        self.rel_line_to (w, 0)
+        self.rel_line_to (0, h)
+        self.rel_line_to (-w, 0)
+        self.close_path()
+
+    def set_source (self, img):
+        self.scene.append ( (SCMD_SET_SOURCE, img) )
+
+    def set_source_surface (self, img, x, y):
+        self.scene.append ( (SCMD_SET_SOURCE_SURFACE, img, x, y) )
+
+    def clip (self):
+        self.scene.append ( (SCMD_CLIP,) )
+
+    def font_extents(self):
+        return self.measure.font_extents (self.font_face, self.font_size)
+
+class SceneProgram(object):
+
+    """A recorded scene (list of (SCMD_*, operands...) tuples) compiled into
+       an opcode array plus a list of operand tuples. Commands are executed
+       through a dispatch table of cairo context methods bound once at
+       compile time, so running a command is one index plus one call.
+
+       The program keeps its own program counter so it can be executed in
+       slices (typewriter effect), see run()."""
+
+    def __init__(self, scene, ctx, bounds):
+
+        self.ctx    = ctx
+        self.bounds = bounds   # (w, h) of the device surface, clips damage
+
+        self.ops    = array('B', [t[0] for t in scene])
+        self.args   = [t[1:] for t in scene]
+
+        self.pc     = 0        # next command to execute
+        self.tpos   = 0        # chars of args[pc] shown so far (SCMD_SHOW_TEXT)
+        self.damage = None
+
+        table = [None] * (SCMD_MAX + 1)
+
+        table[SCMD_SET_SOURCE_RGBA   ] = ctx.set_source_rgba
+        table[SCMD_PAINT             ] = self._paint
+        table[SCMD_SELECT_FONT_FACE  ] = ctx.select_font_face
+        table[SCMD_SET_FONT_SIZE     ] = ctx.set_font_size
+        table[SCMD_MOVE_TO           ] = ctx.move_to
+        table[SCMD_SHOW_TEXT         ] = ctx.show_text
+        table[SCMD_REL_LINE_TO       ] = ctx.rel_line_to
+        table[SCMD_CLOSE_PATH        ] = ctx.close_path
+        table[SCMD_FILL              ] = self._fill
+        table[SCMD_SET_LINE_WIDTH    ] = ctx.set_line_width
+        table[SCMD_SAVE              ] = ctx.save
+        table[SCMD_RESTORE           ] = ctx.restore
+        table[SCMD_SET_SOURCE        ] = ctx.set_source
+        table[SCMD_CLIP              ] = ctx.clip
+        table[SCMD_SET_SOURCE_SURFACE] = ctx.set_source_surface
+        table[SCMD_RECTANGLE         ] = ctx.rectangle
+
+        self.table  = table
+
+    def __len__(self):
+        return len(self.ops)
+
+    def done(self):
+        return self.pc >= len(self.ops)
+
+    def add_damage(self, x1, y1, x2, y2):
+
+        # user space box -> device pixels, grown by one pixel for antialiasing
+
+        dx1, dy1 = self.ctx.user_to_device (x1, y1)
+        dx2, dy2 = self.ctx.user_to_device (x2, y2)
+
+        x1 = max(int(math.floor(min(dx1, dx2))) - 1, 0)
+        y1 = max(int(math.floor(min(dy1, dy2))) - 1, 0)
+        x2 = min(int(math.ceil(max(dx1, dx2))) + 1, self.bounds[0])
+        y2 = min(int(math.ceil(max(dy1, dy2))) + 1, self.bounds[1])
+
+        if x2 > x1 and y2 > y1:
+            self.damage.append ( (x1, y1, x2 - x1, y2 - y1) )
+
+    def _paint(self):
+        if self.damage is not None:
+            self.add_damage (*self.ctx.clip_extents())
+        self.ctx.paint()
+
+    def _fill(self):
+        if self.damage is not None:
+            self.add_damage (*self.ctx.fill_extents())
+        self.ctx.fill()
+
+    def run(self, budget, damage=None):
+        """execute commands until budget is used up (one unit per command,
+           one per char of text, SCMD_SHOW_TEXT may be interrupted and is
+           resumed by the next call). Device rectangles touched are appended
+           to damage unless it is None. Returns the unused budget."""
+
+        ops   = self.ops
+        args  = self.args
+        table = self.table
+        n     = len(ops)
+        pc    = self.pc
+
+        self.damage = damage
+
+        while pc < n and budget > 0:
+
+            op = ops[pc]
+
+            if op == SCMD_SHOW_TEXT:
+                text = args[pc][0]
+                txt  = text[self.tpos:self.tpos + budget]
+                if damage is not None and txt:
+                    x, y = self.ctx.get_current_point()
+                    xb, yb, w, h = self.ctx.text_extents (txt)[:4]
+                    self.add_damage (x + xb, y + yb, x + xb + w, y + yb + h)
+                # show_text() advances the current point, so the next
+                # slice can continue right where this one stopped
+                self.ctx.show_text (txt)
+                self.tpos += len(txt)
+                budget    -= len(txt)
+                if self.tpos < len(text):
+                    break
+                self.tpos = 0
+                pc       += 1
+                continue
+
+            table[op](*args[pc])
+            budget -= 1
+            pc     += 1
+
+        self.pc     = pc
+        self.damage = None
+
+        return budget
+
+#
+# peephole optimizer
+#
+
+def _collapse_rectangles(scene):
+
+    # move_to + 3 rel_line_to + close_path is exactly what cairo_rectangle() does
+
+    res = []
+    i   = 0
+    n   = len(scene)
+
+    while i < n:
+
+        t = scene[i]
+
+        if t[0] == SCMD_MOVE_TO and i + 4 < n:
+            a, b, c, d = scene[i+1:i+5]
+            if a[0] == SCMD_REL_LINE_TO and b[0] == SCMD_REL_LINE_TO and \
+               c[0] == SCMD_REL_LINE_TO and d[0] == SCMD_CLOSE_PATH and \
+               a[2] == 0 and b[1] == 0 and c[1] == -a[1] and c[2] == 0:
+                res.append ( (SCMD_RECTANGLE, t[1], t[2], a[1], b[2]) )
+                i += 5
+                continue
+
+        res.append (t)
+        i += 1
+
+    return res
+
+def _device_box(matrix, x1, y1, x2, y2):
+
+    dx1, dy1 = matrix.transform_point (x1, y1)
+    dx2, dy2 = matrix.transform_point (x2, y2)
+
+    return min(dx1, dx2), min(dy1, dy2), max(dx1, dx2), max(dy1, dy2)
+
+def _drop_occluded(scene, matrix, bounds):
+
+    # an opaque, unclipped paint or rectangle fill hides every earlier paint
+    # or rectangle fill whose pixels it covers completely. Boxes are compared
+    # in device pixels: the candidate by every pixel it touches, the occluder
+    # only by the pixels it covers fully, so antialiased edges are preserved.
+
+    dead       = set()
+    candidates = []     # (first index, last index, touched device pixel box)
+
+    opaque     = False
+    clipped    = False
+    stack      = []
+    moves_only = True   # current path contains nothing but move_to
+    rect_ok    = False  # last rectangle started on such a path
+
+    for i, t in enumerate(scene):
+
+        op = t[0]
+
+        if op == SCMD_SET_SOURCE_RGBA:
+            opaque = t[4] >= 1.0
+        elif op == SCMD_SET_SOURCE or op == SCMD_SET_SOURCE_SURFACE:
+            opaque = False
+        elif op == SCMD_SAVE:
+            stack.append ( (opaque, clipped) )
+        elif op == SCMD_RESTORE:
+            if stack:
+                opaque, clipped = stack.pop()
+        elif op == SCMD_CLIP:
+            clipped    = True
+            moves_only = True
+        elif op == SCMD_REL_LINE_TO or op == SCMD_CLOSE_PATH:
+            moves_only = False
+        elif op == SCMD_RECTANGLE:
+            rect_ok    = moves_only
+            moves_only = False
+
+        elif op == SCMD_PAINT or op == SCMD_FILL:
+
+            if op == SCMD_PAINT:
+                first = i
+                box   = (0, 0, bounds[0], bounds[1])
+                cover = (-INF, -INF, INF, INF)
+
+            elif scene[i-1][0] == SCMD_RECTANGLE and rect_ok:
+                x, y, w, h = scene[i-1][1:]
+                first = i - 1
+                box   = _device_box (matrix, x, y, x + w, y + h)
+                cover = (math.ceil(box[0]), math.ceil(box[1]), math.floor(box[2]), math.floor(box[3]))
+                box   = (math.floor(box[0]), math.floor(box[1]), math.ceil(box[2]), math.ceil(box[3]))
+
+            else:
+                first = None
+
+            if op == SCMD_FILL:
+                moves_only = True
+
+            if first is None:
+                continue
+
+            if opaque and not clipped:
+                alive = []
+                for c in candidates:
+                    cb = c[2]
+                    if cb[0] >= cover[0] and cb[1] >= cover[1] and cb[2] <= cover[2] and cb[3] <= cover[3]:
+                        dead.update (range(c[0], c[1] + 1))
+                    else:
+                        alive.append (c)
+                candidates = alive
+
+            candidates.append ( (first, i, box) )
+
+    return [t for i, t in enumerate(scene) if not i in dead]
+
+# state setters: opcode -> kind of state they modify
+_SETTERS = { SCMD_SET_SOURCE_RGBA    : 0, 
+             SCMD_SET_SOURCE         : 0,
+             SCMD_SET_SOURCE_SURFACE : 0,
+             SCMD_SELECT_FONT_FACE   : 1,
+             SCMD_SET_FONT_SIZE      : 2,
+             SCMD_SET_LINE_WIDTH     : 3 }
+
+# opcodes consuming state: opcode -> kinds they use
+_USERS   = { SCMD_PAINT              : (0, ),
+             SCMD_FILL               : (0, ),
+             SCMD_SHOW_TEXT          : (0, 1, 2) }
+
+def _drop_redundant_state(scene):
+
+    # drop setters that re-set the current value and setters overwritten
+    # before anything used them (line width has no users as we never stroke,
+    # so only identical values are dropped there)
+
+    dead    = set()
+    state   = [None, None, None, None]   # operands of the current setter per kind
+    pending = [None, None, None, None]   # index of a setter not used yet
+    stack   = []
+
+    for i, t in enumerate(scene):
+
+        op = t[0]
+
+        if op in _SETTERS:
+
+            kind = _SETTERS[op]
+
+            # patterns and surfaces can't be compared, always keep those
+            value = t if op == SCMD_SET_SOURCE_RGBA or kind > 0 else None
+
+            if value is not None and value == state[kind]:
+                dead.add (i)
+                continue
+
+            if pending[kind] is not None and kind < 3:
+                dead.add (pending[kind])
+
+            state[kind]   = value
+            pending[kind] = i
+
+        elif op in _USERS:
+            for kind in _USERS[op]:
+                pending[kind] = None
+
+        elif op == SCMD_SAVE:
+            stack.append (list(state))
+            pending = [None, None, None, None]
+
+        elif op == SCMD_RESTORE:
+            state   = stack.pop() if stack else [None, None, None, None]
+            pending = [None, None, None, None]
+
+    return [t for i, t in enumerate(scene) if not i in dead]
+
+def optimize_scene(scene, matrix, bounds):
+    """peephole pass over a recorded scene: collapses rectangle paths into
+       SCMD_RECTANGLE, drops paints/fills hidden by later opaque ones and
+       redundant state changes. matrix is the user to device transform
+       of the target context, bounds the visible (w, h) in device pixels.
+       Returns the optimized command list."""
+
+    scene = _collapse_rectangles (scene)
+    scene = _drop_occluded (scene, matrix, bounds)
+    scene = _drop_redundant_state (scene)
+
+    return scene
+
+#
+# benchmark: per command overhead of the old if/elif interpreter vs. SceneProgram
+#
+
+def _interpret(ctx, scene):
+
+    # the former HAL.scene_draw dispatch, kept for comparison
+
+    for t in scene:
+
+        scmd = t[0]
+        if scmd == SCMD_SET_SOURCE_RGBA:
+            ctx.set_source_rgba (t[1], t[2], t[3], t[4])
+        elif scmd == SCMD_PAINT:
+            ctx.paint()
+        elif scmd == SCMD_SELECT_FONT_FACE:
+            ctx.select_font_face (t[1])
+        elif scmd == SCMD_SET_FONT_SIZE:
+            ctx.set_font_size (t[1])
+        elif scmd == SCMD_MOVE_TO:
+            ctx.move_to (t[1], t[2])
+        elif scmd == SCMD_SHOW_TEXT:
+            ctx.show_text (t[1])
+        elif scmd == SCMD_REL_LINE_TO:
+            ctx.rel_line_to (t[1], t[2])
+        elif scmd == SCMD_CLOSE_PATH:
+            ctx.close_path()
+        elif scmd == SCMD_FILL:
+            ctx.fill()
+        elif scmd == SCMD_SET_LINE_WIDTH:
+            ctx.set_line_width (t[1])
+        elif scmd == SCMD_SAVE:
+            ctx.save()
+        elif scmd == SCMD_RESTORE:
+            ctx.restore()
+        elif scmd == SCMD_SET_SOURCE:
+            ctx.set_source(t[1])
+        elif scmd == SCMD_CLIP:
+            ctx.clip()
+        elif scmd == SCMD_SET_SOURCE_SURFACE:
+            ctx.set_source_surface(t[1], t[2], t[3])
+        elif scmd == SCMD_RECTANGLE:
+            ctx.rectangle(t[1], t[2], t[3], t[4])
+
+class _NullContext(object):
+
+    # accepts every call the scene makes, isolates the dispatch cost
+
+    def _nop(self, *args):
+        return None
+
+    def user_to_device(self, x, y):
+        return x, y
+
+    def __getattr__(self, name):
+        return self._nop
+
+def _bench_scene(n):
+
+    scene = [ (SCMD_SET_SOURCE_RGBA, 0.0, 0.0, 0.5, 1.0), (SCMD_PAINT, ),
+              (SCMD_SELECT_FONT_FACE, 'Liberation Sans'), (SCMD_SET_FONT_SIZE, 16) ]
+
+    i = 0
+    while len(scene) < n:
+        y = 20 + (i % 30) * 18
+        scene.extend ( [ (SCMD_SET_SOURCE_RGBA, 0.2, 0.2, 0.2, 1.0),
+                         (SCMD_MOVE_TO, 10, y), (SCMD_REL_LINE_TO, 300, 0),
+                         (SCMD_REL_LINE_TO, 0, 16), (SCMD_REL_LINE_TO, -300, 0),
+                         (SCMD_CLOSE_PATH, ), (SCMD_FILL, ),
+                         (SCMD_SET_SOURCE_RGBA, 1.0, 1.0, 1.0, 1.0),
+                         (SCMD_MOVE_TO, 12, y + 14), (SCMD_SHOW_TEXT, 'line %d' % i) ] )
+        i += 1
+
+    return scene[:n]
+
+def _bench(name, ctx, scene, rounds):
+
+    t0 = time.time()
+    for r in range(rounds):
+        _interpret(ctx, scene)
+    t_old = time.time() - t0
+
+    t0 = time.time()
+    for r in range(rounds):
+        SceneProgram(scene, ctx, (1024, 1024)).run(sys.maxint)
+    t_new = time.time() - t0
+
+    cmds = float(len(scene) * rounds)
+    print "%-6s if/elif: %6.2f us/cmd   program (incl. compile): %6.2f us/cmd" % \
+          (name, t_old * 1e6 / cmds, t_new * 1e6 / cmds)
+
+if __name__ == "__main__":
+
+    n     = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    scene = _bench_scene(n)
+
+    print "%d commands" % len(scene)
+
+    _bench ('null',  _NullContext(), scene, 50)
+
+    surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, 1024, 1024)
+    ctx = cairo.Context(surface)
+    ctx.scale (0.75, 1.0)
+
+    _bench ('cairo', ctx, scene, 5)
+
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# timer wheel for periodic jobs at wall clock deadlines
+#
+
+import math
+import time
+
+# seconds per wheel slot, jobs run up to one slot late
+WHEEL_TICK  = 0.1
+
+# slots in the wheel, deadlines further out wait for more turns
+WHEEL_SLOTS = 64
+
+class Job(object):
+
+    def __init__(self, name, period, fn, align, slack):
+
+        self.name     = name
+        self.period   = period   # seconds
+        self.fn       = fn
+        self.align    = align    # deadlines on multiples of period (e.g. minute boundaries)
+        self.slack    = slack    # seconds a job may be held back while the caller is busy
+
+        self.deadline = 0.0
+        self.tick     = 0        # wheel tick the job is due at
+
+        self.runs     = 0
+        self.deferred = 0        # times held back while busy
+        self.overruns = 0        # periods skipped because a run came too late
+        self.late_sum = 0.0
+        self.late_max = 0.0
+        self.time_max = 0.0      # longest run
+
+    def stats(self):
+        return "%s: %d runs, late %.1f ms avg %.1f ms max, %d deferred, %d overruns, %.1f ms max run" % \
+               (self.name, self.runs, self.late_sum * 1000.0 / max(self.runs, 1), self.late_max * 1000.0,
+                self.deferred, self.overruns, self.time_max * 1000.0)
+
+class Scheduler(object):
+
+    """hashed timer wheel: a job due at wall clock time t sits in slot
+       ceil(t / tick) % slots and runs once the wheel has turned past it.
+       run() is called by the main loop and only runs jobs while it is idle,
+       unless a job has already waited longer than its slack."""
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+
+        self.tick   = tick
+        self.wheel  = [ [] for i in range(slots) ]
+        self.cursor = int(time.time() / tick)   # last tick processed
+        self.jobs   = []
+        self.steps  = 0                         # wall clock steps backwards
+
+    def _insert(self, job, tick):
+        job.tick = max(tick, self.cursor + 1)
+        self.wheel[job.tick % len(self.wheel)].append(job)
+
+    def _schedule(self, job, now):
+
+        if job.align:
+            job.deadline = (math.floor(now / job.period) + 1) * job.period
+        else:
+            job.deadline = now + job.period
+
+        self._insert (job, int(math.ceil(job.deadline / self.tick)))
+
+    def every(self, name, period, fn, align=False, slack=None):
+        """run fn() every period seconds, first time one period from now
+           (or at the next multiple of period if align is set)"""
+
+        if slack is None:
+            slack = period / 2.0
+
+        job = Job(name, period, fn, align, slack)
+        self.jobs.append(job)
+        self._schedule (job, time.time())
+
+        return job
+
+    def _check_step(self, now):
+
+        # the wall clock was set back (NTP, manually): the wheel would stand
+        # still until the clock caught up again, so start over from now
+        if int(now / self.tick) >= self.cursor:
+            return
+
+        self.steps += 1
+        self.cursor = int(now / self.tick)
+        for slot in self.wheel:
+            del slot[:]
+        for job in self.jobs:
+            self._schedule (job, now)
+
+    def next_deadline(self):
+        """time the next job is due at the wheel's resolution"""
+
+        now = time.time()
+        self._check_step (now)
+
+        return min([job.tick for job in self.jobs]) * self.tick if self.jobs else now + 60.0
+
+    def _run_job(self, job, now):
+
+        late = now - job.deadline
+
+        # a late run covers the periods it missed
+        missed = int(late / job.period)
+        if missed > 0:
+            job.overruns += missed
+
+        t0 = time.time()
+        job.fn()
+        dt = time.time() - t0
+
+        job.runs     += 1
+        job.late_sum += late
+        job.late_max  = max(job.late_max, late)
+        job.time_max  = max(job.time_max, dt)
+
+        job.deadline += (missed + 1) * job.period
+        self._insert (job, int(math.ceil(job.deadline / self.tick)))
+
+    def run(self, idle=True):
+        """run the jobs that are due, returns the number of jobs run"""
+
+        now   = time.time()
+        self._check_step (now)
+
+        ticks = int(now / self.tick) - self.cursor
+        if ticks <= 0:
+            return 0
+
+        # after a long stall one turn visits every slot
+        first = self.cursor + 1
+        self.cursor += ticks
+        ticks = min(ticks, len(self.wheel))
+
+        due = []
+        for t in range(first, first + ticks):
+            slot = self.wheel[t % len(self.wheel)]
+            keep = [ job for job in slot if job.tick >  self.cursor ]
+            due.extend([ job for job in slot if job.tick <= self.cursor ])
+            slot[:] = keep
+
+        n = 0
+        for job in due:
+
+            if not idle and now - job.deadline < job.slack:
+                job.deferred += 1
+                self._insert (job, self.cursor + 1)
+                continue
+
+            self._run_job (job, now)
+            n += 1
+
+        return n
+
+    def stats(self):
+        return "%d clock steps; %s" % (self.steps, "; ".join([job.stats() for job in self.jobs]))
+
+if __name__ == "__main__":
+
+    sched = Scheduler()
+
+    sched.every ('fast',   0.25, lambda: None)
+    sched.every ('second', 1.0,  lambda: time.sleep(0.05), align=True)
+
+    t_end = time.time() + 5.0
+    while time.time() < t_end:
+        time.sleep (max(0.0, sched.next_deadline() - time.time()))
+        sched.run ()
+
+    print sched.stats()
@@ -19,10 +19,25 @@
 #
 
 import re, os
+import time
+import threading
+from collections import deque
+
+# seconds between readings of a sensor (a DS18B20 conversion alone takes ~750ms)
+SAMPLE_INTERVAL = 30
+
+# readings the moving average is taken over
+AVERAGE_SAMPLES = 5
+
+# seconds measure_temperatures() waits for the first reading of a sensor
+FIRST_READING_TIMEOUT = 2.0
+
+# value reported for a sensor without a valid reading
+NO_READING      = -100.0
 
 # function: read and parse sensor data file
 def read_sensor(path):
-    value = -100.0
+    value = NO_READING
     try:
         f = open(path, "r")
         line = f.readline()
@@ -36,10 +51,88 @@ def read_sensor(path):
         print "Error reading", path, ": ", e
     return value
 
+class TemperatureSampler(object):
+
+    """reads a sensor on its own thread every interval seconds and keeps
+       the latest valid reading, its time and a moving average"""
+
+    def __init__(self, path, interval=SAMPLE_INTERVAL):
+
+        self.path     = path
+        self.interval = interval
+        self.lock     = threading.Lock()
+
+        self.value    = NO_READING
+        self.time     = 0.0
+        self.average  = NO_READING
+        self.history  = deque(maxlen=AVERAGE_SAMPLES)
+
+        # set once the first read attempt is done, successful or not
+        self.ready    = threading.Event()
+
+        self.thread = threading.Thread (target=self._sample_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _sample_loop(self):
+
+        while True:
+
+            t0 = time.time()
+            value = read_sensor (self.path)
+
+            # keep the last good reading on errors, its time tells its age
+            if value != NO_READING:
+                with self.lock:
+                    self.history.append(value)
+                    self.value   = value
+                    self.time    = time.time()
+                    self.average = sum(self.history) / len(self.history)
+
+            self.ready.set()
+
+            time.sleep (max(0.0, self.interval - (time.time() - t0)))
+
+    def reading(self):
+        """(latest value, its time, moving average)"""
+        with self.lock:
+            return (self.value, self.time, self.average)
+
+_samplers = {}
+
+# set once the boot reading has waited for the first samples
+_first_read_done = False
+
+def start_sampling (*paths):
+    """start background samplers for the given sensors (once per sensor)"""
+
+    for path in paths:
+        if not path in _samplers:
+            _samplers[path] = TemperatureSampler(path)
+
 def measure_temperatures (term_location, sensor_path_inside, sensor_path_outside):
 
-    temp_inside = read_sensor (sensor_path_inside)
-    temp_outside = read_sensor (sensor_path_outside)
+    """latest readings of both sensors from the samplers' cache. Only the
+       first call (at boot) waits, for up to FIRST_READING_TIMEOUT, until
+       both sensors have been read once; NO_READING if a sensor failed"""
+
+    global _first_read_done
+
+    start_sampling (sensor_path_inside, sensor_path_outside)
+
+    inside  = _samplers[sensor_path_inside]
+    outside = _samplers[sensor_path_outside]
+
+    # later calls come from the main loop and must not block it, even
+    # while a sensor (e.g. a hung 1-wire bus) still has not answered
+    if not _first_read_done:
+        _first_read_done = True
+        deadline = time.time() + FIRST_READING_TIMEOUT
+        for sampler in (inside, outside):
+            sampler.ready.wait (max(0.0, deadline - time.time()))
+
+    temp_inside  = inside.reading()[0]
+    temp_outside = outside.reading()[0]
 
     return (term_location, temp_inside, temp_outside)
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# memoized text measurement for robinson layout
+#
+
+import cairo
+
+# entries in the (face, size, text) memo before it is flushed
+MAX_EXTENTS = 4096
+
+# strings up to this length are composed from per glyph extents
+SHORT_TEXT  = 16
+
+INF = float('inf')
+
+class TextMeasure(object):
+
+    def __init__(self, ctx):
+
+        # measure on a private 1x1 surface set up like the render context ctx
+        # (same transformation and font options -> same metrics), so layout
+        # never touches the render state and may run on another thread
+
+        self.ctx     = cairo.Context (cairo.ImageSurface (cairo.FORMAT_ARGB32, 1, 1))
+        self.ctx.set_matrix (ctx.get_matrix())
+        self.ctx.set_font_options (ctx.get_font_options())
+
+        self.extents = {}   # (face, size, text) -> text extents
+        self.fonts   = {}   # (face, size)       -> font extents
+        self.glyphs  = {}   # (face, size)       -> { char: text extents }
+
+        self.hits     = 0
+        self.composed = 0
+        self.misses   = 0
+
+    def _measure(self, font_face, font_size, text):
+        self.ctx.select_font_face (font_face)
+        self.ctx.set_font_size (font_size)
+        return self.ctx.text_extents (text)
+
+    def _compose(self, font_face, font_size, text):
+
+        # the toy font api places glyphs by their advances without kerning,
+        # so the ink box of a string is the union of its glyphs' ink boxes
+
+        font = (font_face, font_size)
+        if not font in self.glyphs:
+            self.glyphs[font] = {}
+        glyphs = self.glyphs[font]
+
+        x  =  y =  0.0
+        x1 = y1 =  INF
+        x2 = y2 = -INF
+
+        for c in text:
+
+            g = glyphs.get(c)
+            if g is None:
+                g = self._measure (font_face, font_size, c)
+                glyphs[c] = g
+
+            xb, yb, w, h, xa, ya = g
+
+            # blanks have no ink
+            if w > 0 and h > 0:
+                x1 = min(x1, x + xb)
+                y1 = min(y1, y + yb)
+                x2 = max(x2, x + xb + w)
+                y2 = max(y2, y + yb + h)
+
+            x += xa
+            y += ya
+
+        if x1 == INF:
+            return (0.0, 0.0, 0.0, 0.0, x, y)
+
+        return (x1, y1, x2 - x1, y2 - y1, x, y)
+
+    def text_extents(self, font_face, font_size, text):
+
+        key = (font_face, font_size, text)
+
+        res = self.extents.get(key)
+        if res is not None:
+            self.hits += 1
+            return res
+
+        if len(text) <= SHORT_TEXT:
+            self.composed += 1
+            res = self._compose (font_face, font_size, text)
+        else:
+            self.misses += 1
+            res = self._measure (font_face, font_size, text)
+
+        if len(self.extents) >= MAX_EXTENTS:
+            self.extents.clear()
+        self.extents[key] = res
+
+        return res
+
+    def font_extents(self, font_face, font_size):
+
+        font = (font_face, font_size)
+
+        res = self.fonts.get(font)
+        if res is None:
+            self.ctx.select_font_face (font_face)
+            self.ctx.set_font_size (font_size)
+            res = self.ctx.font_extents ()
+            self.fonts[font] = res
+
+        return res
+
+    def stats(self):
+        total = self.hits + self.composed + self.misses
+        return "%d lookups, %.1f%% hits, %d composed from glyphs, %d measured" % \
+               (total, 100.0 * self.hits / max(total, 1), self.composed, self.misses)
+